@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import asyncpg
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# share of updates, inserts and deletes of the write load
+WRITE_MIX = [('update', 0.6), ('insert', 0.3), ('delete', 0.1)]
+
+
+def get_args():
+    arg_parser = argparse.ArgumentParser(
+        description='alter a generated table on a throwaway local cluster under a write load, '
+                    'unknown arguments are passed to transparent_alter_type',
+        allow_abbrev=False)
+    arg_parser.add_argument('--bin-dir', help='directory of initdb and pg_ctl (default: found by PATH)')
+    arg_parser.add_argument('--port', type=int, default=54329)
+    arg_parser.add_argument('--rows', type=int, default=1000000)
+    arg_parser.add_argument('--width', type=int, default=100, help='bytes of the text payload of a row')
+    arg_parser.add_argument('--partitions', type=int, default=0, help='hash partitions by account_id (0 - plain table)')
+    arg_parser.add_argument('--column', action='append', help='column:new_type to alter (default: id:bigint)')
+    arg_parser.add_argument('--writers', type=int, default=4, help='connections of the write load')
+    arg_parser.add_argument('--write-rate', type=int, default=200, help='writes per second of all writers')
+    arg_parser.add_argument('--load-seconds', type=int, default=5, help='write load measured before the alter')
+    arg_parser.add_argument('--runs', type=int, default=1)
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--setting', action='append', default=[], help='name=value of postgresql.conf')
+    arg_parser.add_argument('--output', default='benchmark.json')
+    arg_parser.add_argument('--keep', action='store_true', help='do not remove the cluster directory')
+    args, tat_args = arg_parser.parse_known_args()
+    args.column = args.column or ['id:bigint']
+    args.tat_args = tat_args
+    return args
+
+
+class Cluster:
+    def __init__(self, args):
+        self.args = args
+        self.bin_dir = args.bin_dir or os.path.dirname(shutil.which('pg_ctl') or '')
+        self.dir = tempfile.mkdtemp(prefix='tat_benchmark_')
+        self.data_dir = os.path.join(self.dir, 'data')
+
+    def run(self, command, *args):
+        subprocess.run([os.path.join(self.bin_dir, command), *args], check=True, stdout=subprocess.DEVNULL)
+
+    def start(self):
+        self.run('initdb', '-D', self.data_dir, '-U', 'postgres', '-A', 'trust', '--no-sync')
+        settings = ['listen_addresses=', 'track_functions=pl', *self.args.setting]
+        options = ' '.join(f"-c '{setting}'" for setting in settings)
+        self.run('pg_ctl', '-D', self.data_dir, '-l', os.path.join(self.dir, 'postgres.log'), '-w',
+                 '-o', f'-p {self.args.port} -k {self.dir} {options}', 'start')
+
+    def stop(self, remove):
+        self.run('pg_ctl', '-D', self.data_dir, '-m', 'fast', '-w', 'stop')
+        if remove:
+            shutil.rmtree(self.dir)
+
+    async def connect(self, database='bench'):
+        return await asyncpg.connect(host=self.dir, port=self.args.port, user='postgres', database=database)
+
+
+async def create_table(cluster, args):
+    con = await cluster.connect('postgres')
+    await con.execute('drop database if exists bench;')
+    await con.execute('create database bench;')
+    await con.close()
+    con = await cluster.connect()
+    # the altered column can not be a partition key
+    partition_by = ' partition by hash (account_id)' if args.partitions else ''
+    primary_key = '' if args.partitions else ' primary key'
+    await con.execute(f'''
+        create table bench(
+          id integer not null{primary_key},
+          account_id integer not null,
+          amount numeric(12, 2) not null,
+          created_at timestamptz not null default now(),
+          payload text not null
+        ){partition_by};
+        create sequence bench_id_seq start {args.rows + 1} owned by bench.id;
+        alter table bench alter column id set default nextval('bench_id_seq');
+    ''')
+    for i in range(args.partitions):  # primary keys of partitions, as in tests/multi_level_partitions
+        await con.execute(f'''
+            create table bench_{i} partition of bench for values with (modulus {args.partitions}, remainder {i});
+            alter table bench_{i} add primary key (id);
+        ''')
+    await con.execute(f'''
+        insert into bench(id, account_id, amount, payload)
+          select i, i % 1000, i % 10000 / 100.0, left(repeat(md5(i::text), {args.width // 32 + 1}), {args.width})
+            from generate_series(1, {args.rows}) i;
+        create index on bench(account_id);
+    ''')
+    await con.execute('vacuum analyze bench;')
+    await con.execute('checkpoint;')
+    await con.close()
+
+
+class WriteLoad:
+    # writes at a fixed rate, so runs with different code are compared under the same load
+    def __init__(self, cluster, args, seed):
+        self.cluster = cluster
+        self.args = args
+        self.seed = seed
+        self.stopped = asyncio.Event()
+        self.latencies = []
+        self.rows = {'insert': 0, 'delete': 0}
+        self.errors = 0
+        self.start_time = None
+        self.stop_time = None
+
+    async def writer(self, i):
+        rnd = random.Random(self.seed * 1000 + i)
+        con = await self.cluster.connect()
+        interval = self.args.writers / self.args.write_rate
+        next_time = time.time()
+        try:
+            while not self.stopped.is_set():
+                operation = rnd.choices([name for name, _ in WRITE_MIX], [share for _, share in WRITE_MIX])[0]
+                ts = time.time()
+                try:
+                    if operation == 'update':
+                        await con.execute('update bench set amount = amount + 1 where id = $1',
+                                          rnd.randint(1, self.args.rows))
+                    elif operation == 'insert':
+                        await con.execute('insert into bench(account_id, amount, payload) values ($1, 1, $2)',
+                                          rnd.randint(1, 1000), 'x' * self.args.width)
+                        self.rows['insert'] += 1
+                    else:
+                        result = await con.execute('delete from bench where id = $1', rnd.randint(1, self.args.rows))
+                        self.rows['delete'] += int(result.split()[-1])
+                except asyncpg.PostgresError:
+                    self.errors += 1
+                self.latencies.append(time.time() - ts)
+                next_time += interval
+                await asyncio.sleep(max(next_time - time.time(), 0))
+        finally:
+            await con.close()
+
+    async def run(self):
+        self.start_time = time.time()
+        await asyncio.gather(*(self.writer(i) for i in range(self.args.writers)))
+        self.stop_time = time.time()
+
+    def stop(self):
+        self.stopped.set()
+
+    def get_stats(self):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return {
+            'writes': len(latencies),
+            'writes_per_second': round(len(latencies) / (self.stop_time - self.start_time), 1),
+            'errors': self.errors,
+            'latency_ms_mean': round(statistics.mean(latencies) * 1000, 3),
+            'latency_ms_p50': round(latencies[len(latencies) // 2] * 1000, 3),
+            'latency_ms_p99': round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+            'latency_ms_max': round(latencies[-1] * 1000, 3),
+        }
+
+
+async def run_load(cluster, args, seed, seconds):
+    load = WriteLoad(cluster, args, seed)
+    task = asyncio.create_task(load.run())
+    await asyncio.sleep(seconds)
+    load.stop()
+    await task
+    return load
+
+
+async def run_tat(cluster, args, run_dir):
+    progress_file = os.path.join(run_dir, 'progress.jsonl')
+    command = [
+        sys.executable, '-c', 'from transparent_alter_type.main import main; main()',
+        '-h', cluster.dir, '-p', str(args.port), '-U', 'postgres', '-d', 'bench', '-t', 'bench',
+        *(argument for column in args.column for argument in ['-c', column]),
+        '--progress-interval', '1', '--progress-file', progress_file, '--progress-format', 'json',
+        *args.tat_args
+    ]
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)  # the code of this checkout is measured
+    ts = time.time()
+    with open(os.path.join(run_dir, 'tat.log'), 'w') as log:
+        process = await asyncio.create_subprocess_exec(*command, stdout=log, stderr=subprocess.STDOUT, env=env)
+        returncode = await process.wait()
+    if returncode:
+        raise Exception(f'transparent_alter_type failed with code {returncode}, see {run_dir}/tat.log')
+    with open(progress_file) as f:
+        metrics = [json.loads(line) for line in f]
+    return time.time() - ts, metrics[-1]
+
+
+def per_second(count, ms):
+    return round(count * 1000 / ms, 1) if ms else None
+
+
+async def run_benchmark(cluster, args, run, run_dir):
+    await create_table(cluster, args)
+    con = await cluster.connect()
+    before = await run_load(cluster, args, args.seed + run, args.load_seconds)
+    load = WriteLoad(cluster, args, args.seed + run)
+    load_task = asyncio.create_task(load.run())
+    try:
+        seconds, metrics = await run_tat(cluster, args, run_dir)
+    finally:
+        load.stop()
+        await load_task
+    rows = await con.fetchval('select count(*) from bench')
+    expected_rows = args.rows + before.rows['insert'] - before.rows['delete'] + load.rows['insert'] - \
+        load.rows['delete']
+    await con.close()
+    during = load.get_stats()
+    return {
+        'run': run + 1,
+        'seconds': round(seconds, 3),
+        'phase_seconds': metrics['phase_seconds'],
+        'copied_rows': metrics['copied_rows'],
+        'copy_ms': metrics['copy_ms'],
+        'copy_rows_per_job_second': per_second(metrics['copied_rows'], metrics['copy_ms']),
+        'applied_rows': metrics['applied_rows'],
+        'apply_ms': metrics['apply_ms'],
+        'apply_rows_per_second': per_second(metrics['applied_rows'], metrics['apply_ms']),
+        'lock_held_ms': metrics['lock_held_ms'],
+        'lock_attempts': metrics['lock_attempts'],
+        'lock_blocked_ms': metrics['lock_blocked_ms'],
+        'writes_before': before.get_stats(),
+        'writes_during': during,
+        'write_latency_overhead': round(during['latency_ms_mean'] / before.get_stats()['latency_ms_mean'], 3),
+        'rows_ok': rows == expected_rows,
+    }
+
+
+def get_medians(runs):
+    medians = {}
+    for key, value in runs[0].items():
+        if key != 'run' and isinstance(value, (int, float)) and not isinstance(value, bool):
+            values = [run[key] for run in runs if run[key] is not None]
+            medians[key] = statistics.median(values) if values else None
+    return medians
+
+
+async def main():
+    args = get_args()
+    cluster = Cluster(args)
+    cluster.start()
+    failed = True
+    try:
+        con = await cluster.connect('postgres')
+        server_version = await con.fetchval('show server_version')
+        await con.close()
+        runs = []
+        for run in range(args.runs):
+            run_dir = os.path.join(cluster.dir, f'run_{run + 1}')
+            os.mkdir(run_dir)
+            result = await run_benchmark(cluster, args, run, run_dir)
+            print(json.dumps(result))
+            runs.append(result)
+        failed = False
+    finally:
+        cluster.stop(remove=not (args.keep or failed))  # logs of a failed run are kept
+    benchmark = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'server_version': server_version,
+        'rows': args.rows,
+        'width': args.width,
+        'partitions': args.partitions,
+        'columns': args.column,
+        'writers': args.writers,
+        'write_rate': args.write_rate,
+        'settings': args.setting,
+        'tat_args': args.tat_args,
+        'runs': runs,
+        'median': get_medians(runs),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(benchmark, f, indent=2)
+        f.write('\n')
+    print(f'results: {args.output}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -143,6 +143,106 @@ psql -t -c "select 'analytics.hit: ' ||
                    end
               from analytics.hit"
 
+echo
+echo "======================================================="
+echo "rebuild with other options:"
+# every table is rebuilt again with the same types (--force) while it is changed the same way as above,
+# so its count stays and its sum grows by the update every time (analytics.page is not changed, every deleted page
+# would be checked by the foreign keys of analytics.session)
+
+fill_communication() {
+    psql -c "insert into analytics.communication(id, type, duration)
+             select i, type, i % 100
+               from generate_series(2000001, 3000000) i
+              cross join unnest(enum_range(null::analytics.communication_type_mnemonic)) as type"
+}
+
+change_communication() {
+    psql -c "update analytics.communication
+                set duration = duration + 20
+              where id between 20 and 30"
+    psql -c "delete from analytics.communication
+              where id > 200"
+    psql -c "insert into analytics.communication(id, type, duration)
+             select i, type, i % 100
+               from generate_series(1000001, 1000100) i
+              cross join unnest(enum_range(null::analytics.communication_type_mnemonic)) as type"
+}
+
+fill_session() {
+    psql -c "insert into analytics.session(page_id, ts, is_loaded, duration)
+             select i % 200 + 1, '2024-01-01'::date + (random() * 58)::int, random() < 0.1, i % 10
+               from generate_series(1, 1000000) i"
+}
+
+change_session() {
+    psql -c "update analytics.session
+                set duration = duration + 20
+              where id < 1000"
+    psql -c "delete from analytics.session
+              where id > 2000"
+    psql -c "insert into analytics.session(page_id, ts, is_loaded, duration)
+             select i % 200 + 1, '2024-01-01'::date + (random() * 58)::int, random() < 0.1, i % 10
+               from generate_series(1, 1000) i"
+}
+
+# usage: check_sum TABLE RESULT CONDITION LABEL
+check_sum() {
+    psql -t -c "select 'analytics.$1 $4: ' ||
+                       case
+                         when '$2' = 'ok' and $3
+                           then 'ok'
+                         else 'FAILED'
+                       end
+                  from analytics.$1" | grep -v "^$"
+}
+
+# usage: rebuild TABLE CONDITION OPTIONS...
+rebuild() {
+    local table=$1 condition=$2 result=ok
+    shift 2
+    fill_$table
+    transparent_alter_type -t analytics.$table -c "id:bigint" --force --copy-data-jobs 2 --create-index-jobs 4 "$@" &
+    local pid=$!
+    sleep 1.1  # the changes are made in parallel with transparent_alter_type
+    change_$table
+    wait $pid || result=FAILED
+    check_sum $table $result "$condition" "$*"
+}
+
+# usage: resume TABLE CONDITION OPTIONS...
+resume() {
+    local table=$1 condition=$2 result=ok
+    shift 2
+    fill_$table
+    transparent_alter_type -t analytics.$table -c "id:bigint" --force --copy-data-jobs 2 --create-index-jobs 4 "$@" &
+    local pid=$!
+    # the run is killed after its first saved batch, the trigger keeps capturing the changes into delta
+    while kill -0 $pid 2> /dev/null && ! psql -At -c "select 1 from analytics.${table}__tat_state
+                                                       where last_pk is not null" 2> /dev/null | grep -q 1; do
+        sleep 0.1
+    done
+    kill -9 $pid
+    wait $pid || true
+    change_$table
+    transparent_alter_type -t analytics.$table -c "id:bigint" --force --copy-data-jobs 2 --create-index-jobs 4 "$@" \
+        --resume || result=FAILED
+    check_sum $table $result "$condition" "$* --resume"
+}
+
+rebuild communication "count(1) = 900 and sum(duration) = 45870" --batch-size 100000 --delta-rotation
+rebuild communication "count(1) = 900 and sum(duration) = 46530" --batch-size 100000 --delta-capture statement
+resume communication "count(1) = 900 and sum(duration) = 47190" --batch-size 100000
+rebuild session "count(1) = 3000 and sum(duration) = 53460" --delta-keys-only
+if [ "${PG_VERSION%%.*}" -ge 14 ]; then
+    rebuild session "count(1) = 3000 and sum(duration) = 73440" --batch-size 100000 --batch-mode ctid
+fi
+
+echo
+echo "diff table structure after rebuild:"
+pg_export $PGDATABASE /tmp/exp_tat_test_rebuild
+diff -x "public.sql" -qr /tmp/exp_tat_test_rebuild/schemas/ final_database/schemas && echo " all tables: ok"
+
 #psql -t -c "select count(1), sum(url)
 #              from analytics.page"
 #psql -t -c "select count(1), sum(duration)
@@ -0,0 +1,44 @@
+import pytest
+
+from transparent_alter_type.tat import TAT
+
+
+def numeric_typmod(precision, scale):
+    return (precision << 16 | scale) + 4
+
+
+def type_change(old_type, old_typmod=-1, new_typmod=-1, same_type=True, binary_coercible=False,
+                rebuilds_indexes=False):
+    return {'old_type': old_type, 'old_typmod': old_typmod, 'new_typmod': new_typmod, 'same_type': same_type,
+            'binary_coercible': binary_coercible, 'rebuilds_indexes': rebuilds_indexes}
+
+
+@pytest.mark.parametrize('change, catalog_only', [
+    # another type: binary coercible without a modifier only
+    (type_change('character varying', 14, same_type=False, binary_coercible=True), True),  # varchar(10) -> text
+    (type_change('integer', same_type=False, binary_coercible=True), True),
+    (type_change('text', new_typmod=14, same_type=False, binary_coercible=True), False),  # text -> varchar(10)
+    (type_change('integer', same_type=False), False),  # integer -> bigint
+    (type_change('integer', same_type=False, binary_coercible=True, rebuilds_indexes=True), False),  # -> oid
+    # the same type with a larger or removed modifier
+    (type_change('character varying', 14, 24), True),
+    (type_change('character varying', 24, 14), False),
+    (type_change('character varying', 14, -1), True),
+    (type_change('character varying', -1, 14), False),
+    (type_change('bit varying', 10, 20), True),
+    (type_change('timestamp with time zone', 3, 6), True),
+    (type_change('timestamp with time zone', 6, 3), False),
+    (type_change('character', 14, 24), False),  # char is padded, it is rewritten
+    (type_change('character varying', 14, 24, rebuilds_indexes=True), False),  # index on lower(column)
+    # numeric keeps its scale
+    (type_change('numeric', numeric_typmod(10, 2), numeric_typmod(14, 2)), True),
+    (type_change('numeric', numeric_typmod(10, 2), numeric_typmod(10, 2)), True),
+    (type_change('numeric', numeric_typmod(14, 2), numeric_typmod(10, 2)), False),
+    (type_change('numeric', numeric_typmod(10, 2), numeric_typmod(14, 4)), False),
+    (type_change('numeric', numeric_typmod(10, 4), numeric_typmod(14, 2)), False),
+    (type_change('numeric', numeric_typmod(10, 0), numeric_typmod(1000, 0)), True),
+    (type_change('numeric', numeric_typmod(10, 2), -1), True),
+    (type_change('numeric', -1, numeric_typmod(10, 2)), False),
+])
+def test_is_catalog_only_change(change, catalog_only):
+    assert TAT.is_catalog_only_change(change) is catalog_only
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from transparent_alter_type.scheduler import Scheduler
+
+
+def test_failure_stops_running_tasks():
+    events = []
+
+    async def slow(name):
+        try:
+            await asyncio.sleep(1)
+            events.append(f'{name} done')
+        except asyncio.CancelledError:
+            events.append(f'{name} canceled')
+            raise
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise Exception('failed')
+
+    async def run():
+        scheduler = Scheduler(2)
+        scheduler.add(slow('running'), 'copy', 10)
+        scheduler.add(fail(), 'copy', 5)
+        scheduler.add(slow('waiting'), 'copy', 1)
+        with pytest.raises(Exception, match='failed'):
+            await scheduler.run()
+        await asyncio.sleep(1.1)
+
+    asyncio.run(run())
+    assert events == ['running canceled']
+
+
+def test_dependencies_and_group_limits():
+    events = []
+    running = {'index': 0, 'max': 0}
+
+    async def copy(name):
+        await asyncio.sleep(0.01)
+        events.append(name)
+
+    async def index(name):
+        running['index'] += 1
+        running['max'] = max(running['max'], running['index'])
+        await asyncio.sleep(0.01)
+        running['index'] -= 1
+        events.append(name)
+
+    async def run():
+        scheduler = Scheduler(3, {'index': 1})
+        copy_task = scheduler.add(copy('copy'), 'copy', 1)
+        scheduler.add(index('index 1'), 'index', 2, [copy_task])
+        scheduler.add(index('index 2'), 'index', 3, [copy_task])
+        await scheduler.run()
+
+    asyncio.run(run())
+    assert events == ['copy', 'index 2', 'index 1']
+    assert running['max'] == 1
+
+
+def test_failure_stops_waiting_workers():
+    events = []
+
+    async def copy(name):
+        events.append(f'{name} started')
+        await asyncio.sleep(0.01)
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise Exception('failed')
+
+    async def run():
+        # the second worker waits for the slot of the group, the failed task frees it
+        scheduler = Scheduler(2, {'copy': 1})
+        scheduler.add(fail(), 'copy', 2)
+        scheduler.add(copy('next copy'), 'copy', 1)
+        with pytest.raises(Exception, match='failed'):
+            await scheduler.run()
+
+    asyncio.run(run())
+    assert events == []
@@ -1,16 +1,74 @@
 import datetime
+import math
 import time
 
 
+class ExportedSnapshot:
+    # all ctid batches read the same snapshot, so a row moved by a concurrent update is copied exactly once
+    def __init__(self, db):
+        self.db = db
+        self.con = None
+        self.snapshot_id = None
+
+    async def export(self):
+        self.con = await self.db.acquire()
+        await self.con.execute('begin isolation level repeatable read;')
+        self.snapshot_id = await self.con.fetchval('select pg_export_snapshot();')
+
+    async def release(self):
+        if self.con is None:
+            return
+        con, self.con = self.con, None
+        await con.execute('commit;')
+        await self.db.release(con)
+
+
 class DataCopier:
-    def __init__(self, args, table, db):
+    def __init__(self, args, table, db, progress=None, throttle=None, state_table_name=None,
+                 lower_pk=None, upper_pk=None, part_id=1, part_count=1):
         self.args = args
         self.table = table
         self.table_name = self.table['name']
         self.pk_columns = self.table['pk_columns']
         self.pk_types = self.table['pk_types']
         self.db = db
-        self.last_pk = None
+        self.progress = progress
+        self.throttle = throttle
+        self.throttled_seconds = 0
+        self.state_table_name = state_table_name  # checkpoints of copied ranges for --resume
+        self.lower_pk = lower_pk  # exclusive
+        self.upper_pk = upper_pk  # inclusive
+        self.part_id = part_id
+        self.part_count = part_count
+        self.part = f'{part_id}/{part_count}' if part_count > 1 else None
+        self.last_pk = lower_pk
+        self.batch_size = self.get_initial_batch_size()
+        self.apply_delta_function = None  # set when delta of copied rows is applied during the copy
+        self.apply_delta_time = time.time()
+        self.snapshot = None  # ExportedSnapshot of --batch-mode ctid
+        self.lower_block = None  # inclusive
+        self.upper_block = None  # exclusive
+        self.last_block = None
+        self.rows_per_block = None
+        self.con = None  # own connection of the batch copy with prepared statements
+
+    def clamp_batch_size(self, batch_size):
+        return min(max(batch_size, self.args.batch_size_min), self.args.batch_size_max)
+
+    def get_initial_batch_size(self):
+        if self.args.batch_bytes:
+            row_width = self.table['data_size'] / max(self.table['estimated_rows'], 1)
+            return self.clamp_batch_size(int(self.args.batch_bytes / max(row_width, 1)))
+        if self.args.batch_duration and not self.args.batch_size:
+            return self.args.batch_size_min
+        return self.args.batch_size
+
+    def adapt_batch_size(self, duration):
+        # the change is damped to not follow a single slow or fast batch too much, the size is rounded to a power
+        # of two, so batches reuse a few prepared statements instead of preparing a new one almost every time
+        ratio = self.args.batch_duration / 1000 / max(duration, 0.001)
+        batch_size = self.batch_size * min(max(ratio, 0.5), 2)
+        self.batch_size = self.clamp_batch_size(2 ** round(math.log2(max(batch_size, 1))))
 
     def log(self, message):
         print(f'{self.table_name}: {message}')
@@ -19,30 +77,214 @@ class DataCopier:
     def duration(start_time):
         return str(datetime.timedelta(seconds=int(time.time() - start_time)))
 
+    async def split(self, parts):
+        if parts < 2 or not self.pk_columns:
+            return [self]
+        bounds = await self.get_split_bounds(parts)
+        lower_bounds = [None] + bounds
+        upper_bounds = bounds + [None]
+        return [
+            DataCopier(self.args, self.table, self.db, self.progress, self.throttle, self.state_table_name,
+                       lower_pk, upper_pk, i, len(lower_bounds))
+            for i, (lower_pk, upper_pk) in enumerate(zip(lower_bounds, upper_bounds), 1)
+        ]
+
+    async def pk_to_text(self, pk):
+        # the text output of postgres, it is read back by the input function of the type (bytea, timestamps, ...)
+        if pk is None:
+            return None
+        pk_values = ', '.join(f'${i}::{pk_type}::text' for i, pk_type in enumerate(self.pk_types, 1))
+        return await (self.con or self.db).fetchval(f'select array[{pk_values}];', *pk)
+
+    async def save_state(self, con):
+        await con.execute(f'''
+            insert into {self.state_table_name}(table_name, part_id, part_count, lower_pk, upper_pk)
+              values ($1, $2, $3, $4, $5)
+        ''', self.table_name, self.part_id, self.part_count, await self.pk_to_text(self.lower_pk),
+                          await self.pk_to_text(self.upper_pk))
+
+    async def save_done(self):
+        await (self.con or self.db).execute(f'''
+            update {self.state_table_name}
+               set done = true
+             where table_name = $1 and
+                   part_id = $2
+        ''', self.table_name, self.part_id)
+
+    async def split_blocks(self, parts, snapshot):
+        # blocks added after the snapshot was exported hold only rows invisible to it
+        blocks = await self.db.fetchval(
+            "select pg_relation_size($1::regclass) / current_setting('block_size')::bigint",
+            self.table_name
+        )
+        parts = max(1, min(parts, blocks))
+        copiers = []
+        for i in range(parts):
+            copier = DataCopier(self.args, self.table, self.db, self.progress, self.throttle,
+                                part_id=i + 1, part_count=parts)
+            copier.snapshot = snapshot
+            copier.lower_block = blocks * i // parts
+            copier.upper_block = blocks * (i + 1) // parts
+            copier.last_block = copier.lower_block
+            copier.rows_per_block = max(self.table['estimated_rows'], 1) / max(blocks, 1)
+            copiers.append(copier)
+        return copiers
+
+    async def get_split_bounds(self, parts):
+        pk_columns = ', '.join(self.pk_columns)
+        pk_columns_desc = ', '.join(f'{column} desc' for column in self.pk_columns)
+        # about 100 sampled blocks per part are enough to get evenly filled ranges
+        rows = await self.db.fetch(f'''
+            select distinct on (tile) {pk_columns}
+              from (select {pk_columns}, ntile($1::integer) over (order by {pk_columns}) as tile
+                      from only {self.table_name}
+                           tablesample system (least(100, 100.0 * 100 * $1::integer *
+                                                          current_setting('block_size')::bigint /
+                                                          greatest(pg_relation_size('{self.table_name}'), 1)))) s
+             where tile < $1::integer
+             order by tile, {pk_columns_desc}
+        ''', parts)
+        bounds = []
+        for row in rows:
+            pk = [row[column] for column in self.pk_columns]
+            if not bounds or bounds[-1] != pk:
+                bounds.append(pk)
+        return bounds
+
     async def copy_data(self, i):
         ts = time.time()
-        self.log(f'copy data: start ({i}: {self.table["pretty_data_size"]})')
-        if self.args.batch_size == 0:
+        part = f', range {self.part}' if self.part else ''
+        self.log(f'copy data: start ({i}: {self.table["pretty_data_size"]}{part})')
+        if self.snapshot:
+            await self.copy_data_blocks()
+        elif self.batch_size == 0:
             await self.copy_data_direct()
         else:
             await self.copy_data_batches()
-        self.log(f'copy data: done ({i}: {self.table["pretty_data_size"]}) in {self.duration(ts)}')
+        if self.progress:
+            self.progress.add('copy_ms', int((time.time() - ts) * 1000))
+        if self.apply_delta_function:
+            await self.apply_delta(self.upper_pk)
+        throttled = ''
+        if self.throttled_seconds:
+            throttled = f', throttled: {datetime.timedelta(seconds=int(self.throttled_seconds))}'
+        self.log(f'copy data: done ({i}: {self.table["pretty_data_size"]}{part}) in {self.duration(ts)}{throttled}')
+
+    async def apply_delta(self, upper_pk):
+        # only keys which are already copied, the rest of delta is applied later
+        ts = time.time()
+        rows = await (self.con or self.db).fetchval(
+            f'select "{self.apply_delta_function}"(null, $1, $2);',
+            await self.pk_to_text(self.lower_pk),
+            await self.pk_to_text(upper_pk)
+        )
+        if self.progress:
+            self.progress.add('applied_rows', rows)
+            self.progress.add('apply_ms', int((time.time() - ts) * 1000))
+        part = f' of range {self.part}' if self.part else ''
+        self.log(f'apply delta of copied rows{part}: {rows} rows in {int((time.time() - ts) * 1000)} ms')
+        self.apply_delta_time = time.time()
+
+    async def wait_throttle(self):
+        if self.throttle:
+            self.throttled_seconds += await self.throttle.wait(self.log)
 
     async def copy_data_direct(self):
-        await self.db.execute(f'''
+        await self.wait_throttle()
+        with_lower_pk = self.last_pk is not None
+        done_query = ''
+        if self.state_table_name:
+            # the range is marked as done by the same statement, --resume never copies it again
+            done_query = f'''
+            with done as (
+              update {self.state_table_name}
+                 set done = true
+               where table_name = '{self.table_name}' and
+                     part_id = {self.part_id}
+            )'''
+        result = await self.db.execute(f'''{done_query}
             insert into {self.table_name}__tat_new
               select *
                 from only {self.table_name}
-        ''')
+               where {self.get_pk_range_predicate(with_lower_pk)}
+        ''', *self.get_pk_range_params(with_lower_pk))
+        if self.progress:
+            self.progress.add('copied_rows', int(result.split()[-1]))
+
+    async def copy_data_blocks(self):
+        while self.last_block < self.upper_block:
+            ts = time.time()
+            await self.wait_throttle()
+            next_block = self.upper_block
+            if self.batch_size:
+                next_block = min(self.last_block + max(int(self.batch_size / self.rows_per_block), 1), next_block)
+            async with self.db.transaction(isolation='repeatable_read') as con:
+                await con.execute(f"set transaction snapshot '{self.snapshot.snapshot_id}';")
+                result = await con.execute(f'''
+                    insert into {self.table_name}__tat_new
+                      select *
+                        from only {self.table_name}
+                       where ctid >= '({self.last_block},0)'::tid and
+                             ctid < '({next_block},0)'::tid
+                ''')
+            self.last_block = next_block
+            if self.progress:
+                self.progress.add('copied_rows', int(result.split()[-1]))
+            if self.args.batch_duration:
+                self.adapt_batch_size(time.time() - ts)
 
     async def copy_data_batches(self):
-        last_batch_size = await self.copy_next_batch()
-        while last_batch_size == self.args.batch_size:
-            last_batch_size = await self.copy_next_batch()
+        # one connection per copier, its prepared statements are planned once and reused by all batches
+        self.con = await self.db.acquire()
+        try:
+            statements = {}
+            while True:
+                batch_size = self.batch_size
+                ts = time.time()
+                if await self.copy_next_batch(statements) < batch_size:
+                    break
+                batch_duration = time.time() - ts  # the delta apply below must not shrink the batches
+                apply_delta_seconds = time.time() - self.apply_delta_time
+                if self.apply_delta_function and apply_delta_seconds >= self.args.apply_delta_during_copy:
+                    await self.apply_delta(self.last_pk)
+                if self.args.batch_duration:
+                    self.adapt_batch_size(batch_duration)
+            if self.state_table_name:
+                await self.save_done()
+        finally:
+            con, self.con = self.con, None
+            await self.db.release(con)
+
+    async def load_pk_bounds(self):
+        # bounds saved by --resume are text, they are bound as parameters of their own types
+        pk_values = ', '.join(f'${i}::text::{pk_type}' for i, pk_type in enumerate(self.pk_types, 1))
+        for attr in ['lower_pk', 'upper_pk', 'last_pk']:
+            pk = getattr(self, attr)
+            if pk is not None:
+                setattr(self, attr, list(await self.db.fetchrow(f'select {pk_values};', *pk)))
+
+    def get_pk_param_condition(self, operator, first_param):
+        pk_params = [f'${i}::{pk_type}' for i, pk_type in enumerate(self.pk_types, first_param)]
+        if len(self.pk_columns) == 1:
+            return f'{self.pk_columns[0]} {operator} {pk_params[0]}'
+        else:
+            pk_columns = ', '.join(self.pk_columns)
+            return f'({pk_columns}) {operator} ({", ".join(pk_params)})'
 
-    async def copy_next_batch(self):
+    def get_pk_range_predicate(self, with_lower_pk):
+        conditions = []
+        if with_lower_pk:
+            conditions.append(self.get_pk_param_condition('>', 1))
+        if self.upper_pk is not None:
+            conditions.append(self.get_pk_param_condition('<=', len(conditions) * len(self.pk_columns) + 1))
+        return ' and '.join(conditions) or 'true'
+
+    def get_pk_range_params(self, with_lower_pk):
+        return (self.last_pk if with_lower_pk else []) + (self.upper_pk or [])
+
+    def get_batch_query(self, with_lower_pk):
         pk_columns = ', '.join(self.pk_columns)
-        predicate = self.get_predicate()
+        predicate = self.get_pk_range_predicate(with_lower_pk)
         if len(self.pk_columns) == 1:
             select_query = f'''
                 select max({self.pk_columns[0]}) as {self.pk_columns[0]}, count(1)
@@ -55,36 +297,48 @@ class DataCopier:
                           from batch) x
                  where x.row_number = x.count
             '''
-        batch = await self.db.fetchrow(f'''
+        checkpoint_query = ''
+        if self.state_table_name:
+            # the checkpoint is committed together with the batch
+            last_pk = ', '.join(f'last.{column}::text' for column in self.pk_columns)
+            checkpoint_query = f''',
+            checkpoint as (
+              update {self.state_table_name} s
+                 set last_pk = array[{last_pk}]
+                from last
+               where s.table_name = '{self.table_name}' and
+                     s.part_id = {self.part_id} and
+                     last.count > 0
+            )'''
+        # limit stays a literal, a generic plan with a parameter limit may choose a full scan and sort
+        return f'''
             with batch as (
               insert into {self.table_name}__tat_new
                 select *
                   from only {self.table_name}
                  where {predicate}
                  order by {pk_columns}
-                 limit {self.args.batch_size}
+                 limit {self.batch_size}
               returning {pk_columns}
-            )
-            {select_query}
-        ''')
+            ),
+            last as (
+              {select_query}
+            ){checkpoint_query}
+            select *
+              from last
+        '''
+
+    async def copy_next_batch(self, statements):
+        await self.wait_throttle()
+        with_lower_pk = self.last_pk is not None
+        key = (with_lower_pk, self.batch_size)
+        if key not in statements:
+            statements[key] = await self.con.prepare(self.get_batch_query(with_lower_pk))
+        batch = await statements[key].fetchrow(*self.get_pk_range_params(with_lower_pk))
 
         if batch is None or batch['count'] == 0:
             return 0
         self.last_pk = [batch[column] for column in self.pk_columns]
+        if self.progress:
+            self.progress.add('copied_rows', batch['count'])
         return batch['count']
-
-    def get_last_pk_value(self, i):
-        col_type = self.pk_types[i]
-        if col_type in ['integer', 'bigint']:
-            return str(self.last_pk[i])
-        return f"'{self.last_pk[i]}'::{col_type}"
-
-    def get_predicate(self):
-        if self.last_pk is None:
-            return 'true'
-        if len(self.pk_columns) == 1:
-            return f"{self.pk_columns[0]} > {self.get_last_pk_value(0)}"
-        else:
-            pk_columns = ', '.join(self.pk_columns)
-            pk_values = ', '.join(self.get_last_pk_value(i) for i in range(len(self.pk_columns)))
-            return f'({pk_columns}) > ({pk_values})'
@@ -1,12 +1,37 @@
 import argparse
 import asyncio
+import re
 
+from .multi_tat import MultiTAT
 from .tat import TAT
 
+SIZE_UNITS = {'': 1, 'b': 1, 'kb': 2 ** 10, 'mb': 2 ** 20, 'gb': 2 ** 30, 'tb': 2 ** 40}
+
+
+def size_in_bytes(value):
+    match = re.fullmatch(r'\s*(\d+)\s*([a-z]*)\s*', value.lower())
+    if not match or match.group(2) not in SIZE_UNITS:
+        raise argparse.ArgumentTypeError(f'invalid size: {value}')
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def read_manifest(file_name, columns):
+    # a line per table: table_name [column:new_type ...], the columns of -c are used when none is given
+    tables = []
+    with open(file_name) as f:
+        for line in f:
+            words = line.split('#')[0].split()
+            if words:
+                tables.append((words[0], words[1:] or columns))
+    return tables
+
 
 def main():
     arg_parser = argparse.ArgumentParser(conflict_handler='resolve')
-    arg_parser.add_argument('-t', '--table_name', required=True)
+    arg_parser.add_argument('-t', '--table_name', action='append', default=[],
+                            help='repeat to alter several tables with one pool and one job budget')
+    arg_parser.add_argument('--manifest',
+                            help='file with a line per table: table_name [column:new_type ...]')
     arg_parser.add_argument('-c', '--column', action='append', help='column:new_type', default=[])
     arg_parser.add_argument('-h', '--host')
     arg_parser.add_argument('-p', '--port')
@@ -16,16 +41,91 @@ def main():
     arg_parser.add_argument('-p', '--port')
     arg_parser.add_argument('--copy-data-jobs', type=int, default=1)
     arg_parser.add_argument('--create-index-jobs', type=int, default=2)
+    arg_parser.add_argument('--analyze-jobs', type=int, default=0)
     arg_parser.add_argument('--force', action='store_true')
     arg_parser.add_argument('--cleanup', action='store_true')
-    arg_parser.add_argument('--lock-timeout', type=int, default=5)
-    arg_parser.add_argument('--time-between-locks', type=int, default=10)
+    arg_parser.add_argument('--resume', action='store_true',
+                            help='continue an interrupted run from the saved copy checkpoints')
+    arg_parser.add_argument('--lock-timeout', type=int, default=5,
+                            help='seconds to wait for the lock, halved after an attempt that blocked other sessions')
+    arg_parser.add_argument('--time-between-locks', type=int, default=10,
+                            help='seconds before the second lock attempt, doubled for every next one (with jitter)')
     arg_parser.add_argument('--work-mem', type=str, default='1GB')
+    arg_parser.add_argument('--maintenance-work-mem-budget', type=size_in_bytes,
+                            help='total maintenance_work_mem shared by concurrent index builds, '
+                                 'every build gets a part by its estimated sort size')
+    arg_parser.add_argument('--index-parallel-workers', type=int,
+                            help='max_parallel_maintenance_workers for index builds on tables larger than 1GB '
+                                 '(smaller tables are indexed without parallel workers)')
     arg_parser.add_argument('--min-delta-rows', type=int, default=10000)
     arg_parser.add_argument('--skip-fk-validation', action='store_true')
+    arg_parser.add_argument('--validate-constraints-jobs', type=int, default=1)
     arg_parser.add_argument('--show-queries', action='store_true')
     arg_parser.add_argument('--batch-size', type=int, default=0)
+    arg_parser.add_argument('--batch-mode', choices=['pk', 'ctid'], default='pk',
+                            help='pk: batches by primary key order, ctid: batches by ranges of table blocks '
+                                 '(sequential reads, postgres 14+) read in one exported snapshot')
+    arg_parser.add_argument('--batch-duration', type=int, default=0,
+                            help='copy data in batches of about N ms, the batch size is adapted by measured batches '
+                                 '(starts with --batch-size or --batch-size-min)')
+    arg_parser.add_argument('--batch-bytes', type=size_in_bytes,
+                            help='batch size in bytes of table data, rows are counted by the average row width')
+    arg_parser.add_argument('--batch-size-min', type=int, default=1000)
+    arg_parser.add_argument('--batch-size-max', type=int, default=1000000)
+    arg_parser.add_argument('--copy-data-ranges', type=int, default=1,
+                            help='split each table into N primary key ranges copied in parallel')
+    arg_parser.add_argument('--copy-data-range-min-size', type=size_in_bytes, default='1GB',
+                            help='do not split tables smaller than this size')
+    arg_parser.add_argument('--delta-capture', choices=['row', 'statement'], default='row',
+                            help='row: store changes by a row trigger, statement: by statement triggers with '
+                                 'transition tables (one insert per statement, not for partitioned tables)')
+    arg_parser.add_argument('--delta-keys-only', action='store_true',
+                            help='store only primary keys in the delta, rows are read from the original table '
+                                 'by key when delta is applied (for wide tables)')
+    arg_parser.add_argument('--delta-rotation', action='store_true',
+                            help='capture changes into two delta tables in turn, the drained one is truncated '
+                                 'after apply instead of leaving dead rows')
+    arg_parser.add_argument('--apply-delta-mode', choices=['set', 'row'], default='set',
+                            help='set: collapse delta by key and apply it in bulk (merge on pg15+, '
+                                 'upsert otherwise), row: apply delta row by row')
+    arg_parser.add_argument('--apply-delta-jobs', type=int, default=1,
+                            help='apply delta of partitions in parallel on N jobs')
+    arg_parser.add_argument('--apply-delta-chunk-rows', type=int, default=0,
+                            help='apply delta in chunks of N rows ordered by tat_delta_id (0 - whole delta at once)')
+    arg_parser.add_argument('--apply-delta-during-copy', type=int, default=0,
+                            help='every N seconds of a batch copy apply delta of already copied keys, the unique '
+                                 'index of the key is built before the copy (0 - disabled)')
+    arg_parser.add_argument('--apply-delta-time-budget', type=int, default=0,
+                            help='seconds per catch-up pass before the next one is started (0 - unlimited)')
+    arg_parser.add_argument('--max-lock-ms', type=int, default=0,
+                            help='lock the table only when the apply of the rest of delta under the lock is '
+                                 'estimated within N ms by the measured apply speed (0 - use --min-delta-rows)')
+    arg_parser.add_argument('--max-lock-hold', type=int, default=0,
+                            help='roll back the switch when statements under the access exclusive lock run longer '
+                                 'than N ms, catch up and try again (0 - unlimited)')
+    arg_parser.add_argument('--max-replication-lag', type=size_in_bytes,
+                            help='pause copy batches and index builds while a replica from pg_stat_replication '
+                                 'lags behind more than this size of wal')
+    arg_parser.add_argument('--max-wal-rate', type=size_in_bytes,
+                            help='pause copy batches and index builds while wal is written faster than this size '
+                                 'per second')
+    arg_parser.add_argument('--progress-interval', type=int, default=0,
+                            help='report progress, throughput and eta every N seconds (0 - disabled)')
+    arg_parser.add_argument('--progress-file',
+                            help='also write every progress report to this file')
+    arg_parser.add_argument('--progress-format', choices=['json', 'prometheus'], default='json',
+                            help='json: append a json line per report, prometheus: rewrite a textfile '
+                                 'collector file with the last report')
     args = arg_parser.parse_args()
 
-    t = TAT(args)
+    tables = [(table_name, args.column) for table_name in args.table_name]
+    if args.manifest:
+        tables.extend(read_manifest(args.manifest, args.column))
+    if not tables:
+        arg_parser.error('the following arguments are required: -t/--table_name or --manifest')
+    if len(tables) == 1:
+        args.table_name, args.column = tables[0]
+        t = TAT(args)
+    else:
+        t = MultiTAT(args, tables)
     asyncio.run(t.run())
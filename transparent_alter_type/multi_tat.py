@@ -0,0 +1,87 @@
+import time
+from argparse import Namespace
+
+from .pg_pool import PgPool
+from .progress import Progress
+from .tat import TAT
+from .throttle import Throttle
+
+
+class MultiTAT:
+    # tables share one pool and one build scheduler, every table is switched under its own lock one after another
+    def __init__(self, args, tables):
+        self.args = args
+        self.db = PgPool(args)
+        self.progress = Progress(args, self.db)  # one reporter for all tables, a prometheus file has all of them
+        self.throttle = Throttle(args, self.db)
+        self.tats = [
+            TAT(Namespace(**dict(vars(args), table_name=table_name, column=columns)), pool=self.db,
+                progress=self.progress, throttle=self.throttle)
+            for table_name, columns in tables
+        ]
+
+    def log(self, message):
+        print(f'{len(self.tats)} tables: {message}')
+
+    @staticmethod
+    def get_tat_size(tat):
+        return sum(table.table['data_size'] or 0 for table in [tat] + tat.children)
+
+    async def get_tables_info(self, ts):
+        tats = []
+        for tat in self.tats:
+            await tat.get_table_info()
+            tat.log_startup(ts)
+            if any(tat.table_name == other.table_name for other in tats):
+                raise Exception(f'table {tat.table_name} is given more than once')
+            if tat.columns:
+                tats.append(tat)
+            else:
+                tat.log('no column to alter, skipped (use --force to alter anyway)')
+        self.tats = sorted(tats, key=self.get_tat_size, reverse=True)  # the largest tables first
+
+    async def build_tables_new(self, tats):
+        if not tats:
+            return
+        self.progress.set_phase('build')
+        await TAT.build_tables_new(tats, self.log)
+
+    async def run(self):
+        ts = time.time()
+        await self.db.init_pool()
+        await self.get_tables_info(ts)
+        if not self.tats:
+            print('no column to alter, use --force to alter anyway')
+            return
+
+        if self.args.cleanup:
+            for tat in self.tats:
+                await tat.cancel_autovacuum()
+                await tat.cleanup()
+            return
+
+        self.log(', '.join(f'{tat.table_name} ({tat.table["pretty_size"]})' for tat in self.tats))
+        for tat in self.tats:
+            tat.start()
+        self.progress.set_tables(f'{len(self.tats)} tables', [
+            table_name
+            for tat in self.tats
+            for table_name in tat.get_progress_tables()
+        ])
+        self.progress.start_reporter()
+        try:
+            for tat in self.tats:
+                await tat.prepare()
+            await self.build_tables_new([tat for tat in self.tats if not tat.is_catalog_only()])
+            for tat in self.tats:
+                await tat.switch()
+        except Exception as e:
+            await self.progress.stop_reporter()
+            for tat in self.tats:
+                await tat.abort()
+            raise e
+        for tat in self.tats:
+            await tat.finish(ts)
+        await self.progress.stop_reporter()
+        self.log(f'phases: {self.progress.pretty_phase_durations()}')
+        self.log(f'done in {TAT.duration(ts)}')
@@ -41,13 +41,36 @@ class ConnectWrapper:
         if res:
             return res[0]
 
+    def get_server_pid(self):
+        return self.con.get_server_pid()
+
+    async def prepare(self, query):
+        self.show_query(query, None)
+        return await self.con.prepare(query)
+
 
 class PgPool:
     pool: asyncpg.Pool
+    server_version_num: int
 
     def __init__(self, args):
         self.args = args
 
+    @property
+    def size(self):
+        # while applying delta in parallel inside the lock one more connection holds the lock
+        size = max(self.args.copy_data_jobs, self.args.create_index_jobs, self.args.apply_delta_jobs + 1,
+                   self.args.analyze_jobs, self.args.validate_constraints_jobs)
+        if self.args.batch_mode == 'ctid':  # one more connection holds the exported snapshot
+            size = max(size, self.args.copy_data_jobs + 1)
+        elif self.args.batch_size or self.args.batch_duration or self.args.batch_bytes:
+            # batch copiers keep their connections, one more is left for throttle queries
+            size = max(size, self.args.copy_data_jobs + 1)
+        if self.args.progress_interval:
+            # all jobs can be busy for the whole copy or index build, progress and lock queue samples must not wait
+            size += 1
+        return size
+
     async def init_pool(self) -> None:
         async def init_connection(con):
             con._reset_query = ''
@@ -67,11 +90,12 @@ class PgPool:
             password=self.args.password,
             host=self.args.host,
             port=self.args.port,
-            min_size=max(self.args.copy_data_jobs, self.args.create_index_jobs),
-            max_size=max(self.args.copy_data_jobs, self.args.create_index_jobs),
+            min_size=self.size,
+            max_size=self.size,
             statement_cache_size=0,
             init=init_connection
         )
+        self.server_version_num = int(await self.fetchval('show server_version_num'))
 
     def show_query(self, query, args):
         if not self.args.show_queries:
@@ -100,8 +124,14 @@ class PgPool:
         if res:
             return res[0]
 
+    async def acquire(self) -> ConnectWrapper:
+        return ConnectWrapper(await self.pool.acquire(), self.args.show_queries)
+
+    async def release(self, con: ConnectWrapper) -> None:
+        await self.pool.release(con.con)
+
     @asynccontextmanager
-    async def transaction(self) -> asyncpg.Connection:
+    async def transaction(self, isolation=None) -> asyncpg.Connection:
         async with self.pool.acquire() as con:
-            async with con.transaction():
+            async with con.transaction(isolation=isolation):
                 yield ConnectWrapper(con, self.args.show_queries)
@@ -0,0 +1,229 @@
+import asyncio
+import datetime
+import json
+import os
+import time
+
+
+class Progress:
+    def __init__(self, args, db):
+        self.args = args
+        self.db = db
+        self.table_name = None
+        self.tables = []
+        self.start_time = time.time()
+        self.phase = None
+        self.phase_start_time = None
+        self.phase_durations = {}
+        self.counters = {}
+        self.totals = {}
+        self.last_sample = None
+        self.reporter = None
+
+    @staticmethod
+    def pretty_duration(seconds):
+        if seconds is None:
+            return '-'
+        return str(datetime.timedelta(seconds=int(seconds)))
+
+    @staticmethod
+    def pretty_size(size):
+        for unit in ['bytes', 'kB', 'MB', 'GB']:
+            if abs(size) < 10240:
+                return f'{int(size)} {unit}'
+            size /= 1024
+        return f'{int(size)} TB'
+
+    def set_tables(self, table_name, tables):
+        self.table_name = table_name
+        self.tables = tables
+
+    def set_phase(self, phase):
+        now = time.time()
+        if self.phase:
+            self.phase_durations[self.phase] = self.phase_durations.get(self.phase, 0) + now - self.phase_start_time
+        self.phase = phase
+        self.phase_start_time = now
+
+    def add_total(self, counter, value):
+        # tables of one run share the progress, their totals are summed
+        self.totals[counter] = self.totals.get(counter, 0) + value
+
+    def add(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def start_reporter(self):
+        if self.args.progress_interval:
+            self.reporter = asyncio.create_task(self.run_reporter())
+
+    def pretty_phase_durations(self):
+        return ', '.join(f'{phase} {self.pretty_duration(seconds)}' for phase, seconds in self.phase_durations.items())
+
+    async def stop_reporter(self):
+        self.set_phase(None)
+        if self.reporter:
+            self.reporter.cancel()
+            self.reporter = None
+            await self.safe_report()
+
+    async def run_reporter(self):
+        while True:
+            await asyncio.sleep(self.args.progress_interval)
+            await self.safe_report()
+
+    async def safe_report(self):
+        try:
+            await self.report()
+        except Exception as e:  # progress must not break the work itself
+            print(f'{self.table_name}: progress: failed: {e}')
+
+    async def sample(self):
+        new_tables = [f'{table}__tat_new' for table in self.tables]
+        delta_tables = [f'{table}__tat_delta{suffix}' for table in self.tables for suffix in ['', '_2']]
+        row = await self.db.fetchrow('''
+            select (select coalesce(sum(pg_relation_size(to_regclass(t))), 0)::bigint
+                      from unnest($1::text[]) t) as copied_bytes,
+                   (select coalesce(sum(s.n_live_tup), 0)
+                      from unnest($2::text[]) t
+                     inner join pg_stat_user_tables s
+                             on s.relid = to_regclass(t))::bigint as delta_rows,
+                   (select coalesce(sum(s.n_tup_ins), 0)
+                      from unnest($2::text[]) t
+                     inner join pg_stat_user_tables s
+                             on s.relid = to_regclass(t))::bigint as delta_inserted_rows
+        ''', new_tables, delta_tables)
+        sample = dict(row)
+        sample['time'] = time.time()
+        sample.update(self.counters)
+        if self.db.server_version_num >= 120000:
+            sample['indexes'] = [
+                dict(index)
+                for index in await self.db.fetch('''
+                    select p.relid::regclass::text as table_name,
+                           p.phase,
+                           p.blocks_done,
+                           p.blocks_total,
+                           p.tuples_done,
+                           p.tuples_total
+                      from pg_stat_progress_create_index p
+                     where p.relid = any(select to_regclass(t) from unnest($1::text[]) t)
+                ''', new_tables)
+            ]
+        return sample
+
+    def get_rate(self, sample, counter):
+        if not self.last_sample:
+            return None
+        seconds = sample['time'] - self.last_sample['time']
+        if seconds <= 0:
+            return None
+        # tables are dropped and renamed by the switch, counters of them must not go backwards
+        return max(sample.get(counter, 0) - self.last_sample.get(counter, 0), 0) / seconds
+
+    @staticmethod
+    def get_index_fraction(index):
+        # a build scans the table first (blocks) and then loads the sorted tuples (tuples)
+        if index['tuples_total']:
+            return 0.5 + 0.5 * index['tuples_done'] / index['tuples_total']
+        if index['blocks_total']:
+            return 0.5 * index['blocks_done'] / index['blocks_total']
+        return 0
+
+    @staticmethod
+    def get_eta(remaining, rate):
+        if not rate or rate <= 0:
+            return None
+        return max(remaining, 0) / rate
+
+    async def collect(self):
+        sample = await self.sample()
+        now = sample['time']
+        metrics = {
+            'table': self.table_name,
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'phase': self.phase or 'done',
+            'elapsed_seconds': int(now - self.start_time),
+            'phase_elapsed_seconds': int(now - self.phase_start_time) if self.phase else None,
+            'copied_bytes': sample['copied_bytes'],
+            'total_bytes': self.totals.get('data_size', 0),
+            'copy_bytes_per_second': self.get_rate(sample, 'copied_bytes'),
+            'copied_rows': sample.get('copied_rows', 0),
+            'copy_rows_per_second': self.get_rate(sample, 'copied_rows'),
+            'copy_ms': sample.get('copy_ms', 0),
+            'indexes_done': sample.get('indexes_done', 0),
+            'indexes_total': self.totals.get('indexes', 0),
+            'indexes_in_progress': sample.get('indexes', []),
+            'delta_rows': sample['delta_rows'],
+            'delta_rows_per_second': self.get_rate(sample, 'delta_inserted_rows'),
+            'applied_rows': sample.get('applied_rows', 0),
+            'apply_rows_per_second': self.get_rate(sample, 'applied_rows'),
+            'apply_ms': sample.get('apply_ms', 0),
+            'lock_held_ms': sample.get('lock_held_ms', 0),
+            'lock_attempts': sample.get('lock_attempts', 0),
+            'lock_blocked_ms': sample.get('lock_blocked_ms', 0),
+        }
+        metrics['copy_eta_seconds'] = self.get_eta(
+            metrics['total_bytes'] - metrics['copied_bytes'],
+            metrics['copy_bytes_per_second']
+        )
+        indexes_done = metrics['indexes_done'] + sum(
+            self.get_index_fraction(index) for index in metrics['indexes_in_progress']
+        )
+        if self.phase == 'build' and indexes_done:
+            metrics['index_eta_seconds'] = self.get_eta(
+                metrics['indexes_total'] - indexes_done,
+                indexes_done / (now - self.phase_start_time)
+            )
+        else:
+            metrics['index_eta_seconds'] = None
+        if metrics['apply_rows_per_second'] is not None and metrics['delta_rows_per_second'] is not None:
+            metrics['catch_up_eta_seconds'] = self.get_eta(
+                metrics['delta_rows'],
+                metrics['apply_rows_per_second'] - metrics['delta_rows_per_second']
+            )
+        else:
+            metrics['catch_up_eta_seconds'] = None
+        metrics['phase_seconds'] = {phase: round(seconds, 3) for phase, seconds in self.phase_durations.items()}
+        self.last_sample = sample
+        return metrics
+
+    def log(self, metrics):
+        message = f'progress: {metrics["phase"]} {self.pretty_duration(metrics["phase_elapsed_seconds"])}'
+        if metrics['phase'] == 'build':
+            copy_percent = 100 * metrics['copied_bytes'] / max(metrics['total_bytes'], 1)
+            message += (f'; copy: {min(copy_percent, 100):.0f}% '
+                        f'{self.pretty_size(metrics["copy_bytes_per_second"] or 0)}/s '
+                        f'eta {self.pretty_duration(metrics["copy_eta_seconds"])}'
+                        f'; indexes: {metrics["indexes_done"]}/{metrics["indexes_total"]} '
+                        f'eta {self.pretty_duration(metrics["index_eta_seconds"])}')
+        elif metrics['phase'] == 'switch':
+            message += (f'; delta: {metrics["delta_rows"]} rows '
+                        f'+{int(metrics["delta_rows_per_second"] or 0)} rows/s, '
+                        f'applied {int(metrics["apply_rows_per_second"] or 0)} rows/s '
+                        f'eta {self.pretty_duration(metrics["catch_up_eta_seconds"])}')
+        print(f'{self.table_name}: {message}')
+
+    def write_json(self, metrics):
+        with open(self.args.progress_file, 'a') as f:
+            f.write(json.dumps(metrics, default=str) + '\n')
+
+    def write_prometheus(self, metrics):
+        lines = []
+        for name, value in metrics.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f'tat_{name}{{table="{self.table_name}",phase="{metrics["phase"]}"}} {value}')
+        for phase, seconds in metrics['phase_seconds'].items():
+            lines.append(f'tat_phase_seconds{{table="{self.table_name}",phase="{phase}"}} {seconds}')
+        tmp_file_name = f'{self.args.progress_file}.tmp'
+        with open(tmp_file_name, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file_name, self.args.progress_file)  # node_exporter must never read a partial file
+
+    async def report(self):
+        metrics = await self.collect()
+        self.log(metrics)
+        if self.args.progress_file:
+            if self.args.progress_format == 'prometheus':
+                self.write_prometheus(metrics)
+            else:
+                self.write_json(metrics)
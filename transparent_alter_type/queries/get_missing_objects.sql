@@ -0,0 +1,10 @@
+select array_agg(o.name order by o.n)
+  from unnest($1::text[], $2::text[]) with ordinality o(kind, name, n)
+ where case o.kind
+         when 'table' then to_regclass(o.name) is null
+         when 'function' then to_regproc(quote_ident(o.name)) is null
+         when 'trigger' then not exists(select
+                                          from pg_trigger tg
+                                         where tg.tgrelid = to_regclass(o.name) and
+                                               tg.tgname = 'store__tat_delta')
+       end
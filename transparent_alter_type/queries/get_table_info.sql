@@ -1,20 +1,74 @@
+with recursive tables as (
+  select $1::regclass::oid as oid, 0 as level
+  union all
+  select i.inhrelid, tables.level + 1 as level
+    from tables
+   inner join pg_inherits i
+           on i.inhparent = tables.oid
+), foreign_keys as (
+  -- constraints of both sides are joined to all tables at once, pg_constraint has no index by confrelid
+  select fk.table_oid,
+         coalesce(array_agg(format('alter table %s add constraint %s %s not valid;',
+                                   fk.conrelid::regclass::text,
+                                   fk.conname,
+                                   pg_get_constraintdef(fk.oid))),
+                  '{{}}') as create_constraints,
+         coalesce(array_agg(format('alter table %s validate constraint %s;',
+                                   fk.conrelid::regclass::text,
+                                   fk.conname)),
+                  '{{}}') as validate_constraints,
+         coalesce(array_agg(format('alter table %s drop constraint %s;',
+                                   fk.conrelid::regclass::text,
+                                   fk.conname))
+                           filter (where fk.conrelid <> fk.table_oid),
+                  '{{}}') as drop_constraints
+    from (select tables.oid as table_oid, fk.oid, fk.conrelid, fk.conname
+            from tables
+           inner join pg_constraint fk
+                   on fk.conrelid = tables.oid
+           where fk.contype = 'f'
+          union
+          select tables.oid as table_oid, fk.oid, fk.conrelid, fk.conname
+            from tables
+           inner join pg_constraint fk
+                   on fk.confrelid = tables.oid
+           where fk.contype = 'f') fk
+   group by fk.table_oid
+), functions as {materialized}(
+  -- functions of system schemas do not use types of user tables and views, pg_proc is read once for all tables
+  select f.oid,
+         f.prokind,
+         f.proacl,
+         f.prorettype,
+         f.proargtypes::oid[] || coalesce(f.proallargtypes, '{{}}') as argtypes
+    from pg_proc f
+   where f.pronamespace not in ('pg_catalog'::regnamespace, 'information_schema'::regnamespace)
+)
 select tn.table_name as name,
        t.relname as name_without_schema,
        t.relkind::text as kind,
        pg_size_pretty(pg_total_relation_size(t.oid)) as pretty_size,
        pg_size_pretty(pg_relation_size(t.oid)) as pretty_data_size,
        pg_relation_size(t.oid) as data_size,
+       case
+         when t.reltuples > 0 or (t.reltuples = 0 and t.relpages > 0)
+           then t.reltuples::bigint
+         -- never analyzed (reltuples is -1 since postgres 14 and 0 before): rows of the table pages by the widths
+         -- of columns, with page and tuple headers
+         else (pg_relation_size(t.oid) / current_setting('block_size')::bigint
+               * (current_setting('block_size')::bigint - 24) / (coalesce(att.row_width, 0) + 28))::bigint
+       end as estimated_rows,
        att.all_columns,
        att.column_types,
        pk.pk_columns,
        pk.pk_types,
        d.comment,
-       i.create_indexes,
+       i.indexes,
        i.rename_indexes,
        chk.create_constraints as create_check_constraints,
-       fk.drop_constraints,
-       uni.create_constraints || fk.create_constraints as create_constraints,
-       fk.validate_constraints,
+       coalesce(fk.drop_constraints, '{{}}') as drop_constraints,
+       uni.create_constraints || coalesce(fk.create_constraints, '{{}}') as create_constraints,
+       coalesce(fk.validate_constraints, '{{}}') as validate_constraints,
        p.grant_privileges,
        tg.create_triggers,
        v.drop_views,
@@ -33,7 +87,9 @@ select tn.table_name as name,
        part.partition_expr,
        ri.replica_identity,
        pb.publications
-  from pg_class t
+  from tables
+ inner join pg_class t
+         on t.oid = tables.oid
  cross join lateral (select t.oid::regclass::text as table_name) tn
   left join lateral (select format('comment on table %s__tat_new is %L;',
                                    tn.table_name,
@@ -43,21 +99,43 @@ select tn.table_name as name,
                             d.objsubid = 0 and
                             d.classoid = 'pg_class'::regclass) d
          on true
- cross join lateral (select coalesce(array_agg(replace(replace(pg_get_indexdef(i.indexrelid),
-                                                               ' ON ',
-                                                               '__tat_new ON '),
-                                                       ' USING ',
-                                                       '__tat_new USING ')
-                                               order by cardinality(i.indkey) desc),
-                                     '{}') as create_indexes,
+ cross join lateral (select coalesce(json_agg(json_build_object(
+                                                'definition', replace(replace(pg_get_indexdef(i.indexrelid),
+                                                                              ' ON ',
+                                                                              '__tat_new ON '),
+                                                                      ' USING ',
+                                                                      '__tat_new USING '),
+                                                'method', am.amname,
+                                                'unique_columns', case
+                                                                    when i.indisunique and
+                                                                         i.indpred is null and
+                                                                         i.indexprs is null
+                                                                      then (select array_agg(a.attname)
+                                                                              from pg_attribute a
+                                                                             where a.attrelid = t.oid and
+                                                                                   a.attnum = any((i.indkey::int2[])[0:i.indnkeyatts - 1]))
+                                                                  end,
+                                                'key_width', (select sum(coalesce(st.avg_width, nullif(a.attlen, -1), 32))
+                                                                from unnest((i.indkey::int2[])[0:i.indnkeyatts - 1]) k(attnum)
+                                                                left join pg_attribute a
+                                                                       on a.attrelid = t.oid and
+                                                                          a.attnum = k.attnum
+                                                                left join pg_stats st
+                                                                       on st.schemaname = t.relnamespace::regnamespace::text and
+                                                                          st.tablename = t.relname and
+                                                                          st.attname = a.attname))
+                                              order by cardinality(i.indkey) desc),
+                                     '[]') as indexes,
                             coalesce(array_agg(format('alter index %s.%s rename to %s;',
                                                       ic.relnamespace::regnamespace,
                                                       (ic.relname || '__tat_new')::name,
                                                       ic.relname)),
-                                     '{}') as rename_indexes
+                                     '{{}}') as rename_indexes
                        from pg_index i
                       inner join pg_class ic
                               on ic.oid = i.indexrelid
+                      inner join pg_am am
+                              on am.oid = ic.relam
                       where i.indrelid = t.oid and
                             ic.relname not like '%\_tat') i
   left join lateral (select uni.contype,
@@ -93,7 +171,7 @@ select tn.table_name as name,
                                                    when uni.condeferred
                                                      then 'initially deferred'
                                                  end)),
-                                     '{}') as create_constraints
+                                     '{{}}') as create_constraints
                        from pg_constraint uni
                       where uni.conrelid = t.oid and
                             uni.contype in ('p', 'u')) uni
@@ -101,53 +179,38 @@ select tn.table_name as name,
                                                       tn.table_name,
                                                       chk.conname,
                                                       pg_get_constraintdef(chk.oid))),
-                                     '{}') as create_constraints
+                                     '{{}}') as create_constraints
                        from pg_constraint chk
                       where chk.conrelid = t.oid and
                             chk.contype = 'c' and
                             chk.conname not like '%\_tat') chk
- cross join lateral (select coalesce(array_agg(format('alter table %s add constraint %s %s not valid;',
-                                                      fk.conrelid::regclass::text,
-                                                      fk.conname,
-                                                      pg_get_constraintdef(fk.oid))),
-                                     '{}') as create_constraints,
-                            coalesce(array_agg(format('alter table %s validate constraint %s;',
-                                                      fk.conrelid::regclass::text,
-                                                      fk.conname)),
-                                     '{}') as validate_constraints,
-                            coalesce(array_agg(format('alter table %s drop constraint %s;',
-                                                      fk.conrelid::regclass::text,
-                                                      fk.conname))
-                                              filter (where fk.conrelid <> t.oid),
-                                     '{}') as drop_constraints
-                       from pg_constraint fk
-                      where (fk.conrelid = t.oid
-                             or
-                             fk.confrelid = t.oid) and
-                            fk.contype = 'f') fk
+ left join foreign_keys fk
+        on fk.table_oid = t.oid
  cross join lateral (select coalesce(array_agg(format('grant %s on table %s__tat_new to "%s";',
                                                       p.privileges,
                                                       tn.table_name,
                                                       p.grantee)),
-                                     '{}') as grant_privileges
+                                     '{{}}') as grant_privileges
                        from (select g.grantee, string_agg(g.privilege_type, ', ') as privileges
                                from information_schema.role_table_grants g
                               where g.table_name = t.relname and
                                     g.table_schema = t.relnamespace::regnamespace::text and
                                     g.grantee <> 'postgres'
                               group by g.grantee) p) p
- cross join lateral (select coalesce(array_agg(pg_get_triggerdef(tg.oid) || ';'), '{}') as create_triggers
+ cross join lateral (select coalesce(array_agg(pg_get_triggerdef(tg.oid) || ';'), '{{}}') as create_triggers
                        from pg_trigger tg
                       where tg.tgrelid = t.oid and
+                            tg.tgname not like 'store\_\_tat\_delta%' and
                             not tgisinternal) tg
  cross join lateral (select array_agg(a.attname) as all_columns,
                             json_object_agg(a.attname, a.atttypid::regtype) as column_types,
+                            sum(coalesce(nullif(a.attlen, -1), 32)) as row_width,
                             coalesce(array_agg(format('alter sequence %s owned by %s__tat_new.%s;',
                                                       s.serial_sequence,
                                                       tn.table_name,
                                                       a.attname))
                                               filter (where s.serial_sequence is not null),
-                                     '{}') as alter_sequences
+                                     '{{}}') as alter_sequences
                        from pg_attribute a
                       cross join pg_get_serial_sequence(tn.table_name, a.attname) as s(serial_sequence)
                       where a.attrelid = t.oid and
@@ -166,7 +229,7 @@ select tn.table_name as name,
                                                          from pg_trigger pgt
                                                         where pgt.tgrelid = v.oid::regclass))
                                                order by v.oid),
-                                     '{}') as create_views,
+                                     '{{}}') as create_views,
                             coalesce(json_agg(json_build_object('obj_name', v.oid::regclass,
                                                                 'obj_type', 'table',
                                                                 'acl', v.relacl))
@@ -175,11 +238,11 @@ select tn.table_name as name,
                             coalesce(array_agg(format('comment on view %s is %L;',
                                                       v.oid::regclass, d.description))
                                               filter (where d.description is not null),
-                                     '{}') as comment_views,
+                                     '{{}}') as comment_views,
                             coalesce(array_agg(format('drop view %s;',
                                                       v.oid::regclass)
                                                order by v.oid desc),
-                                     '{}') as drop_views,
+                                     '{{}}') as drop_views,
                             array_agg(v.reltype) as view_type_oids
                        from pg_class v
                        left join pg_description d
@@ -190,18 +253,22 @@ select tn.table_name as name,
                                           from pg_depend d
                                          inner join pg_rewrite rw
                                                  on rw.oid = d.objid
-                                         where d.refobjid = t.oid
+                                         where d.refclassid = 'pg_class'::regclass and
+                                               d.refobjid = t.oid and
+                                               d.classid = 'pg_rewrite'::regclass
                                         union
                                         select rw.ev_class
                                           from w_depend w
                                          inner join pg_depend d
-                                                 on d.refobjid = w.ev_class
+                                                 on d.refclassid = 'pg_class'::regclass and
+                                                    d.refobjid = w.ev_class and
+                                                    d.classid = 'pg_rewrite'::regclass
                                          inner join pg_rewrite rw
                                                  on rw.oid = d.objid
                                       )
                                       select d.ev_class
                                         from w_depend d)) v
- cross join lateral (select coalesce(array_agg(pg_catalog.pg_get_functiondef(f.oid) || ';'), '{}') as create_functions,
+ cross join lateral (select coalesce(array_agg(pg_catalog.pg_get_functiondef(f.oid) || ';'), '{{}}') as create_functions,
                             coalesce(json_agg(json_build_object(
                                                 'obj_name', format('%s(%s)', f.oid::regproc, pg_get_function_identity_arguments(f.oid)),
                                                 'obj_type', case
@@ -215,16 +282,14 @@ select tn.table_name as name,
                             coalesce(array_agg(format('drop function %s(%s);',
                                                       f.oid::regproc::text,
                                                       pg_get_function_identity_arguments(f.oid))),
-                                     '{}') as drop_functions
-                       from pg_proc f
+                                     '{{}}') as drop_functions
+                       from functions f
                       where f.prorettype = t.reltype
                             or
-                            t.reltype = any(f.proargtypes)
-                            or
-                            t.reltype = any(f.proallargtypes)
+                            t.reltype = any(f.argtypes)
                             or
                             f.prorettype = any(v.view_type_oids)) f
- cross join lateral (select coalesce(array_agg(format('alter table %s set (%s);', t.oid::regclass, ro.option)), '{}') as storage_parameters
+ cross join lateral (select coalesce(array_agg(format('alter table %s set (%s);', t.oid::regclass, ro.option)), '{{}}') as storage_parameters
                        from unnest(t.reloptions) as ro(option)) sp
  cross join lateral (select array_agg(i.inhparent::regclass::text) as inherits
                        from pg_inherits i
@@ -267,7 +332,7 @@ select tn.table_name as name,
                        from pg_partitioned_table p
                       where p.partrelid = t.oid) part
          on true
-  left join format('alter table %s replica identity %s',
+  left join format('alter table %s replica identity %s;',
                     t.oid::regclass,
                     case t.relreplident
                       when 'f'
@@ -289,9 +354,9 @@ select tn.table_name as name,
                                 format('alter publication %I add table %s;',
                                        p.pubname,
                                        t.oid::regclass)),
-                              '{}') as publications
+                              '{{}}') as publications
                        from pg_publication_rel pr
                       inner join pg_publication p
                               on p.oid = pr.prpubid
                       where pr.prrelid = t.oid) pb
- where t.oid = any($1::regclass[])
+ order by tables.level, tn.table_name
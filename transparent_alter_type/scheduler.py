@@ -0,0 +1,94 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class Task:
+    def __init__(self, coro, group, weight=0, depends_on=()):
+        self.coro = coro
+        self.group = group
+        self.weight = weight
+        self.depends_on = list(depends_on)
+        self.done = False
+
+
+class Scheduler:
+    # runs the heaviest task whose dependencies are done, groups of tasks can have own worker limits
+    def __init__(self, worker_count, group_limits=None):
+        self.worker_count = worker_count
+        self.group_limits = group_limits or {}
+        self.tasks = []
+        self.running = {}
+        self.failed = False
+
+    def add(self, coro, group, weight=0, depends_on=()):
+        task = Task(coro, group, weight, depends_on)
+        self.tasks.append(task)
+        return task
+
+    def get_next_task(self):
+        ready_tasks = [
+            task
+            for task in self.tasks
+            if all(dependency.done for dependency in task.depends_on)
+            and self.running.get(task.group, 0) < self.group_limits.get(task.group, self.worker_count)
+        ]
+        if not ready_tasks:
+            return None
+        task = max(ready_tasks, key=lambda t: t.weight)
+        self.tasks.remove(task)
+        return task
+
+    async def run(self):
+        state_changed = asyncio.Condition()
+
+        async def worker():
+            while True:
+                async with state_changed:
+                    task = None if self.failed else self.get_next_task()
+                    while task is None:
+                        if not self.tasks or self.failed:
+                            return
+                        await state_changed.wait()
+                        task = None if self.failed else self.get_next_task()
+                    self.running[task.group] = self.running.get(task.group, 0) + 1
+                try:
+                    await task.coro
+                    task.done = True
+                except BaseException:
+                    self.failed = True
+                    raise
+                finally:
+                    async with state_changed:
+                        self.running[task.group] -= 1
+                        state_changed.notify_all()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.worker_count)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker_task in workers:  # tasks still running after a failure are stopped before it is raised
+                worker_task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            for task in self.tasks:  # never started because of a failure
+                task.coro.close()
+            self.tasks = []
+
+
+class Budget:
+    def __init__(self, total):
+        self.total = total
+        self.available = total
+        self.changed = asyncio.Condition()
+
+    @asynccontextmanager
+    async def acquire(self, amount):
+        amount = min(amount, self.total)
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.available >= amount)
+            self.available -= amount
+        try:
+            yield amount
+        finally:
+            async with self.changed:
+                self.available += amount
+                self.changed.notify_all()
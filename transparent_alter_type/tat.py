@@ -1,5 +1,6 @@
 import asyncio
 import os
+import random
 import sys
 import re
 from argparse import Namespace
@@ -12,8 +13,26 @@ from typing import List
 import asyncpg
 from pg_export.acl import acl_to_grants
 
-from .data_copier import DataCopier
+from .data_copier import DataCopier, ExportedSnapshot
 from .pg_pool import PgPool
+from .progress import Progress
+from .scheduler import Budget, Scheduler
+from .throttle import Throttle
+
+INDEX_METHOD_COST_FACTORS = {'btree': 1, 'hash': 1, 'spgist': 2, 'gist': 3, 'gin': 4, 'brin': 0}
+INDEX_TUPLE_OVERHEAD = 16
+PARALLEL_INDEX_METHODS = {'btree': 110000, 'brin': 170000, 'gin': 180000}  # method: minimal server version
+PARALLEL_INDEX_MIN_SIZE = 2 ** 30
+INDEX_MIN_MEMORY = 64 * 2 ** 20
+INDEX_PARTICIPANT_MIN_MEMORY = 32 * 2 ** 20
+NON_CONVERGING_PASSES = 10
+MAX_LOCK_HOLD_ATTEMPTS = 3
+LOCK_RETRY_MAX_DOUBLINGS = 3  # the delay between lock attempts grows up to 8 * --time-between-locks
+LOCK_TIMEOUT_MIN = 0.2
+LOCK_QUEUE_SAMPLE_INTERVAL = 0.1
+# types of which a larger modifier is only a catalog change (postgres skips their length coercion)
+TYPMOD_EXTENSIBLE_TYPES = ['character varying', 'bit varying', 'numeric', 'time without time zone',
+                           'time with time zone', 'timestamp without time zone', 'timestamp with time zone']
 
 
 class TableKind(Enum):
@@ -26,7 +45,7 @@ class TAT:
     children: List["TAT"]
     table_kind: TableKind
 
-    def __init__(self, args, is_sub_table=False, pool=None):
+    def __init__(self, args, is_sub_table=False, pool=None, progress=None, throttle=None):
         self.args = args
         self.is_sub_table = is_sub_table
         self.table_name = None
@@ -36,7 +55,15 @@ class TAT:
                          'type': c.split(':')[1]}
                         for c in args.column]
         self.db = pool or PgPool(args)
+        self.own_progress = progress is None  # a shared progress is reported by its owner
+        self.progress = progress or Progress(args, self.db)
+        self.throttle = throttle or Throttle(args, self.db)
         self.table_locked = False
+        self.lock_time = None
+        self.lock_attempt = 0
+        self.lock_timeout = args.lock_timeout  # halved after an attempt that blocked other sessions
+        self.state_table_name = None
+        self.catalog_ms = 0
 
     @staticmethod
     def duration(start_time):
@@ -49,26 +76,62 @@ class TAT:
     def log_border():
         print('-' * 50)
 
-    async def cancel_autovacuum(self, con=None):
+    async def cancel_autovacuum(self, con=None, tables=None):
         if con is None:
             con = self.db
-        if await con.fetch(f'''
+        if await con.fetch('''
             select pg_cancel_backend(pid)
               from pg_stat_activity
              where state = 'active' and
                    backend_type = 'autovacuum worker' and
-                   query ~ '{self.table_name}';
-        '''):
+                   query ~ any($1::text[]);
+        ''', [table.table_name for table in tables or [self]]):
             self.log('autovacuum canceled')
 
-    async def cancel_all_autovacuum(self, con):
-        if await con.fetch('''
+    @staticmethod
+    def get_cancel_all_autovacuum_query():
+        return '''
             select pg_cancel_backend(pid)
               from pg_stat_activity
              where state = 'active' and
                    backend_type = 'autovacuum worker';
-        '''):
-            self.log('autovacuum canceled')
+        '''
+
+    @staticmethod
+    def get_script(*queries):
+        # statements and lists of statements are sent in one round trip
+        return '\n'.join(
+            query
+            for item in queries
+            for query in ([item] if isinstance(item, str) or not item else item)
+            if query
+        )
+
+    async def execute_script(self, message, script):
+        self.log(message)
+        await self.db.execute(script)
+
+    async def run_table_scripts(self, name, scripts, reverse=False):
+        # every table has own transaction, partitions are run in parallel over the pool after their parents
+        # (or before them with reverse), so the time grows with tables / jobs instead of tables * round trips
+        ts = time.time()
+        scheduler = Scheduler(self.db.size)
+        tasks = {}
+        children_tasks = {}
+        for table, message, script in reversed(scripts) if reverse else scripts:
+            parent_name = table.table['inherits'][0] if table.is_sub_table else None
+            if reverse:
+                depends_on = children_tasks.get(table.table_name, [])
+            else:
+                depends_on = [tasks[parent_name]] if parent_name in tasks else []
+            task = scheduler.add(table.execute_script(message, script), name, 0, depends_on)
+            tasks[table.table_name] = task
+            children_tasks.setdefault(parent_name, []).append(task)
+        await scheduler.run()
+        if len(tasks) > 1:
+            ms = (time.time() - ts) * 1000
+            self.log(f'{name}: {len(tasks)} tables in {int(ms)} ms, {ms / len(tasks):.1f} ms per table '
+                     f'on {self.db.size} jobs')
 
     @staticmethod
     def get_query(query_file_name):
@@ -76,25 +139,18 @@ class TAT:
         return open(full_file_name).read()
 
     async def get_table_info(self, table=None):
-        children = []
-        tables_data = {}
+        tables = []
         if table:
             self.table = table
         else:
-            db_table_name = await self.db.fetchval('select $1::regclass::text', self.args.table_name)
-            children = await self.db.fetchval(
-                self.get_query('get_child_tables.sql'),
-                db_table_name
-            )
-            table_names = [db_table_name] + children
-            tables_data = {
-                table['name']: table
-                for table in await self.db.fetch(
-                    self.get_query('get_table_info.sql'),
-                    table_names
-                )
-            }
-            self.table = tables_data[db_table_name]
+            # the table and all its partitions by one query, partitions are ordered by level
+            ts = time.time()
+            # ctes are always materialized before postgres 12, the keyword appeared with the option to inline them
+            materialized = 'materialized ' if self.db.server_version_num >= 120000 else ''
+            tables = await self.db.fetch(self.get_query('get_table_info.sql').format(materialized=materialized),
+                                         self.args.table_name)
+            self.table = tables[0]
+            self.catalog_ms = int((time.time() - ts) * 1000)
 
         self.table_kind = TableKind(self.table['kind'])
         self.table_name = self.table['name']
@@ -102,209 +158,869 @@ class TAT:
         if not self.table['pk_columns'] and self.table_kind == TableKind.regular:
             raise Exception(f'table {self.table_name} does not have primary key or not null unique constraint')
 
+        if self.is_sub_table:  # partitions have the column types of the root, its columns are set by it
+            return
+
         if not self.args.force:
+            ts = time.time()
             columns_to_alter = []
-            for column in self.columns:
-                pg_type = await self.db.fetchval('select $1::regtype', column['type'])
-                if self.table['column_types'][column['column']] == pg_type:
-                    print(f'NOTICE: column {self.table_name}.{column["column"]} already has {pg_type} type')
+            for column, type_change in zip(self.columns, await self.get_type_changes(self.columns)):
+                if type_change['same_type'] and type_change['old_typmod'] == type_change['new_typmod']:
+                    print(f'NOTICE: column {self.table_name}.{column["column"]} '
+                          f'already has {type_change["new_type"]} type')
                 else:
+                    column['catalog_only'] = self.is_catalog_only_change(type_change)
                     columns_to_alter.append(column)
-            if len(columns_to_alter) == 0:
-                print('no column to alter, use --force to alter anyway')
-                sys.exit(0)
             self.columns = columns_to_alter
+            self.catalog_ms += int((time.time() - ts) * 1000)
 
-        if not self.is_sub_table:  # all children are processing on root level
-            self.children = [
-                TAT(Namespace(**dict(vars(self.args), table_name=child)), True, self.db)
-                for child in children
-            ]
-            for child in self.children:
-                await child.get_table_info(tables_data[child.args.table_name])
+        self.state_table_name = f'{self.table_name}__tat_state'
+        self.children = [
+            TAT(Namespace(**dict(vars(self.args), table_name=child['name'])), True, self.db, self.progress,
+                self.throttle)
+            for child in tables[1:]
+        ]
+        for child, child_table in zip(self.children, tables[1:]):
+            child.state_table_name = self.state_table_name
+            child.columns = self.columns
+            await child.get_table_info(child_table)
 
-    async def create_table_new(self):
-        if self.table_kind == TableKind.foreign:
-            return
-        self.log(f'create {self.table_name}__tat_new')
+    async def get_type_modifiers(self, type_names):
+        # the modifier is computed by the typmodin function of the type as postgres does for a column definition,
+        # base types of all names are resolved by one query and all modifiers by another one
+        matches = [re.fullmatch(r'([^(]*)\(([^)]*)\)(.*)', type_name.strip()) for type_name in type_names]
+        base_types = await self.db.fetch('''
+            select t.name::regtype::text as name,
+                   p.typmodin::text as typmodin
+              from unnest($1::text[]) with ordinality t(name, i)
+             inner join pg_type p
+                     on p.oid = t.name::regtype
+             order by t.i
+        ''', [match[1] + match[3] if match else type_name for match, type_name in zip(matches, type_names)])
+        typmod_calls = []
+        typmod_params = []
+        for match, base_type in zip(matches, base_types):
+            if not match:
+                continue
+            if base_type['typmodin'] == '-':
+                raise Exception(f'type modifier is not allowed for type {base_type["name"]}')
+            typmod_params.append([modifier.strip() for modifier in match[2].split(',')])
+            typmod_calls.append(f'{base_type["typmodin"]}(${len(typmod_params)}::text[]::cstring[])')
+        typmods = []
+        if typmod_calls:
+            typmods = list(await self.db.fetchrow(f'select {", ".join(typmod_calls)}', *typmod_params))
+        return [
+            (base_type['name'], typmods.pop(0) if match else -1)
+            for match, base_type in zip(matches, base_types)
+        ]
 
-        await self.db.execute(f'''
-            create table {self.table_name}__tat_new(
-              like {self.table_name}
-              including all
-              excluding indexes
-              excluding constraints
-              excluding statistics
-            ){self.table['partition_expr'] or ''};
-        ''')
+    async def get_type_changes(self, columns):
+        type_modifiers = await self.get_type_modifiers([column['type'] for column in columns])
+        type_changes = await self.db.fetch('''
+            select c.name,
+                   a.atttypid::regtype::text as old_type,
+                   a.atttypmod as old_typmod,
+                   format_type(c.new_type::regtype, c.new_typmod) as new_type,
+                   c.new_typmod,
+                   a.atttypid = c.new_type::regtype as same_type,
+                   exists(select from pg_cast pc
+                           where pc.castsource = a.atttypid and
+                                 pc.casttarget = c.new_type::regtype and
+                                 pc.castmethod = 'b') as binary_coercible,
+                   -- alter table builds again indexes of the column with expressions or predicates and indexes
+                   -- whose default operator class of the new type is in another operator family (integer -> oid)
+                   exists(select from pg_depend d
+                           inner join pg_index i
+                                   on i.indexrelid = d.objid
+                           where d.classid = 'pg_class'::regclass and
+                                 d.refclassid = 'pg_class'::regclass and
+                                 d.refobjid = a.attrelid and
+                                 d.refobjsubid = a.attnum and
+                                 (i.indexprs is not null or i.indpred is not null))
+                   or a.atttypid <> c.new_type::regtype and
+                   exists(select from pg_index i
+                           cross join unnest(i.indkey::int2[], i.indclass::oid[]) k(attnum, opclass)
+                           inner join pg_opclass oc
+                                   on oc.oid = k.opclass
+                           where i.indrelid = a.attrelid and
+                                 k.attnum = a.attnum and
+                                 oc.opcdefault and
+                                 -- the default class of the type itself goes before a binary coercible one
+                                 (select nc.opcfamily
+                                    from pg_opclass nc
+                                   where nc.opcmethod = oc.opcmethod and
+                                         nc.opcdefault and
+                                         (nc.opcintype = c.new_type::regtype or
+                                          exists(select from pg_cast pc
+                                                  where pc.castsource = c.new_type::regtype and
+                                                        pc.casttarget = nc.opcintype and
+                                                        pc.castmethod = 'b'))
+                                   order by nc.opcintype = c.new_type::regtype desc
+                                   limit 1) is distinct from oc.opcfamily) as rebuilds_indexes
+              from unnest($2::text[], $3::text[], $4::integer[]) with ordinality c(name, new_type, new_typmod, i)
+              left join pg_attribute a
+                     on a.attrelid = $1::regclass and
+                        a.attname = c.name and
+                        not a.attisdropped
+             order by c.i
+        ''', self.table_name, [column['column'] for column in columns],
+            [new_type for new_type, _ in type_modifiers], [new_typmod for _, new_typmod in type_modifiers])
+        for type_change in type_changes:
+            if type_change['old_type'] is None:
+                raise Exception(f'column {self.table_name}.{type_change["name"]} does not exist')
+        return type_changes
+
+    @staticmethod
+    def is_catalog_only_change(type_change):
+        old_typmod, new_typmod = type_change['old_typmod'], type_change['new_typmod']
+        if type_change['rebuilds_indexes']:
+            return False
+        if not type_change['same_type']:
+            return type_change['binary_coercible'] and new_typmod == -1
+        if type_change['old_type'] not in TYPMOD_EXTENSIBLE_TYPES:
+            return False
+        if new_typmod == -1:
+            return True
+        if old_typmod == -1:
+            return False
+        if type_change['old_type'] == 'numeric':  # the scale is in the low 16 bits and must stay the same
+            return (old_typmod - 4) & 0xffff == (new_typmod - 4) & 0xffff and new_typmod >= old_typmod
+        return new_typmod >= old_typmod
+
+    def is_catalog_only(self):
+        # --force always rebuilds the table, --resume continues a rebuild
+        return (
+            not self.args.force
+            and not self.args.resume
+            and all(column['catalog_only'] for column in self.columns)
+        )
 
-        if self.columns:
-            await self.db.execute(
+    async def get_relation_filenodes(self, con):
+        # indexes are rebuilt under the lock too, when the new type has another operator family (integer -> oid)
+        return await con.fetchval('''
+            select array_agg(pg_relation_filenode(r.oid) order by pg_relation_filenode(r.oid))
+              from unnest($1::text[]) t
+             cross join lateral (select t::regclass::oid as oid
+                                 union all
+                                 select i.indexrelid
+                                   from pg_index i
+                                  where i.indrelid = t::regclass) r
+        ''', [table.table_name for table in self.get_regular_tables()])
+
+    async def drop_depend_views(self, con):
+        await con.execute(self.get_script(*(
+            query
+            for table in [self] + self.children
+            for query in [table.table['drop_views'], table.table['drop_functions']]
+        )))
+
+    async def alter_table_in_place(self):
+        self.log_border()
+        self.log('alter table in place: start')
+        while True:
+            async with self.exclusive_lock_table() as con:
+                if con is None:
+                    continue
+                await self.alter_columns_in_place(con)
+            break
+        self.log('alter table in place: done')
+        # alter column type drops the statistics of the column
+        await self.analyze(f'analyze {self.table_name} ({", ".join(column["column"] for column in self.columns)})')
+
+    async def alter_columns_in_place(self, con):
+        filenodes = await self.get_relation_filenodes(con)
+        await self.drop_depend_views(con)
+        # an unexpected rewrite is canceled soon, the lock must stay short
+        statement_timeout = self.args.max_lock_hold or self.args.lock_timeout * 1000
+        await con.execute(f"set local statement_timeout = '{statement_timeout}ms';")
+        try:
+            await con.execute(
                 ''.join(
                     '''
-                    alter table {name}__tat_new
+                    alter table {name}
                       alter column {column}
-                        type {type} using ({column}::{type});
+                        type {type};
                     '''.format(**self.table, **column)
                     for column in self.columns
                 )
             )
+        except asyncpg.exceptions.QueryCanceledError:
+            raise Exception(f'alter table runs longer than {statement_timeout} ms, it probably rewrites the table, '
+                            f'use --force to rebuild it')
+        await con.execute('set local statement_timeout to default;')
+        if await self.get_relation_filenodes(con) != filenodes:  # rolled back
+            raise Exception('alter table rewrites the table or its indexes, use --force to rebuild it')
+        await self.recreate_depend_objects(con)
 
-        await self.db.execute('\n'.join(self.table['create_check_constraints']))
-        await self.db.execute('\n'.join(self.table['grant_privileges']))
-        await self.db.execute(self.table['comment'])
-        if self.table_kind == TableKind.regular:
-            await self.cancel_autovacuum()
-            await self.db.execute(f'''
-                alter table {self.table_name}          set (autovacuum_enabled = false);
-                alter table {self.table_name}__tat_new set (autovacuum_enabled = false);
-            ''')
-        if self.table['attach_expr']:
-            await self.db.execute(self.table['attach_expr'])
-        elif self.table['inherits']:
-            await self.db.execute(
-                f'alter table {self.table_name}__tat_new inherit {self.table["inherits"][0]}__tat_new'
+    def get_create_table_new_script(self):
+        return self.get_script(
+            f'''
+            create table {self.table_name}__tat_new(
+              like {self.table_name}
+              including all
+              excluding indexes
+              excluding constraints
+              excluding statistics
+            ){self.table['partition_expr'] or ''};
+            ''',
+            [
+                '''
+                alter table {name}__tat_new
+                  alter column {column}
+                    type {type} using ({column}::{type});
+                '''.format(**self.table, **column)
+                for column in self.columns
+            ],
+            self.table['create_check_constraints'],
+            self.table['grant_privileges'],
+            self.table['comment'],
+            self.get_disable_autovacuum_script(),
+            self.table['attach_expr'] or (
+                self.table['inherits']
+                and f'alter table {self.table_name}__tat_new inherit {self.table["inherits"][0]}__tat_new;'
+            ),
+        )
+
+    async def create_table_new(self):
+        tables = [table for table in [self] + self.children if table.table_kind != TableKind.foreign]
+        await self.cancel_autovacuum(tables=tables)
+        await self.run_table_scripts('create tables', [
+            (table, f'create {table.table_name}__tat_new', table.get_create_table_new_script())
+            for table in tables
+        ])
+
+    def get_disable_autovacuum_script(self):
+        if self.table_kind != TableKind.regular:
+            return ''
+        return f'''
+            alter table {self.table_name}          set (autovacuum_enabled = false);
+            alter table {self.table_name}__tat_new set (autovacuum_enabled = false);
+        '''
+
+    async def create_table_state(self):
+        await self.db.execute(f'''
+            create table {self.state_table_name}(
+              table_name text,
+              part_id integer,
+              part_count integer,
+              lower_pk text[],
+              upper_pk text[],
+              last_pk text[],
+              done boolean not null default false,
+              primary key (table_name, part_id)
             )
-        for child in self.children:
-            await child.create_table_new()
+        ''')
 
-    async def create_table_delta(self):
-        if self.table_kind == TableKind.regular:
-            self.log(f'create {self.table_name}__tat_delta')
+    async def check_resume(self):
+        objects = [('table', self.state_table_name)]
+        for table in [self] + self.children:
+            if table.table_kind == TableKind.foreign:
+                continue
+            objects.append(('table', f'{table.table_name}__tat_new'))
+            if table.table_kind == TableKind.regular:
+                objects.extend([
+                    ('table', f'{table.table_name}__tat_delta'),
+                    ('function', f'{table.table_name}__store_delta'),
+                    ('function', f'{table.table_name}__apply_delta'),
+                    ('trigger', table.table_name),
+                ])
+                if self.args.delta_rotation:
+                    objects.extend([
+                        ('table', table.get_delta_table(1)),
+                        ('function', table.get_apply_function(1)),
+                    ])
+        missing_objects = await self.db.fetchval(
+            self.get_query('get_missing_objects.sql'),
+            [kind for kind, name in objects],
+            [name for kind, name in objects]
+        )
+        if missing_objects:
+            raise Exception(f'can not resume, objects not found: {", ".join(missing_objects)}; '
+                            f'use --cleanup and start again')
+        self.log('resume')
+        tables = [table for table in [self] + self.children if table.table_kind == TableKind.regular]
+        await self.cancel_autovacuum(tables=tables)
+        await self.run_table_scripts('disable autovacuum', [
+            (table, 'disable autovacuum', table.get_disable_autovacuum_script())
+            for table in tables
+        ])
+
+    def get_apply_delta_query_name(self):
+        if self.args.delta_keys_only:
+            return 'apply_delta_keys.plpgsql'
+        if self.args.apply_delta_mode == 'row':
+            return 'apply_delta.plpgsql'
+        if self.db.server_version_num >= 150000:
+            return 'apply_delta_merge.plpgsql'
+        return 'apply_delta_upsert.plpgsql'
+
+    def get_delta_table(self, buffer):
+        # with --delta-rotation changes are captured into one of two delta tables while the other one is applied
+        return f'{self.table_name}__tat_delta_2' if buffer else f'{self.table_name}__tat_delta'
 
-            await self.db.execute(f'''
+    def get_apply_function(self, buffer):
+        return f'{self.table_name}__apply_delta_2' if buffer else f'{self.table_name}__apply_delta'
+
+    def get_store_delta_query(self, delta_table):
+        delta_columns = ', '.join(
+            f'"{column}"'
+            for column in self.table['all_columns']
+        )
+        new_values = 'new.*'
+        old_values = 'old.*'
+        if self.args.delta_keys_only:
+            delta_columns = ', '.join(f'"{column}"' for column in self.table['pk_columns'])
+            new_values = ', '.join(f'new."{column}"' for column in self.table['pk_columns'])
+            old_values = ', '.join(f'old."{column}"' for column in self.table['pk_columns'])
+
+        if self.args.delta_capture == 'statement':
+            query = self.get_query('store_delta_statement.plpgsql')
+        else:
+            query = self.get_query('store_delta.plpgsql')
+        return query.format(**self.table, **locals())
+
+    async def get_active_delta_buffer(self, db=None):
+        return int(await (db or self.db).fetchval(
+            "select position('__tat_delta_2' in prosrc) > 0 from pg_proc where oid = to_regproc(quote_ident($1))",
+            f'{self.table_name}__store_delta'
+        ))
+
+    def get_create_table_delta_script(self):
+        queries = []
+        if self.args.delta_keys_only:
+            queries.append(f'''
+                create unlogged table {self.table_name}__tat_delta as
+                  select {', '.join(f'"{column}"' for column in self.table['pk_columns'])}
+                    from {self.table_name}
+                  with no data;
+            ''')
+        else:
+            queries.append(f'''
                 create unlogged table {self.table_name}__tat_delta(
-                  like {self.table_name} excluding all)
+                  like {self.table_name} excluding all);
             ''')
 
-            await self.db.execute(f'''
-                alter table {self.table_name}__tat_delta
-                  add column tat_delta_id serial,
-                  add column tat_delta_op "char";
+        queries.append(f'''
+            alter table {self.table_name}__tat_delta
+              add column tat_delta_id serial primary key,
+              add column tat_delta_op "char";
+        ''')
+
+        if self.args.delta_rotation:
+            queries.append(f'''
+                create unlogged table {self.get_delta_table(1)}(
+                  like {self.table_name}__tat_delta including defaults including indexes);
             ''')
 
-            query = self.get_query('store_delta.plpgsql')
-            await self.db.execute(query.format(**self.table))
+        queries.append(self.get_store_delta_query(self.get_delta_table(0)))
 
-            columns = ', '.join(
-                f'"{column}"'
-                for column in self.table['all_columns']
-            )
-            val_columns = ', '.join(
-                f'r."{column}"'
-                for column in self.table['all_columns']
-            )
-            where = ' and '.join(
-                f't."{column}" = r."{column}"'
-                for column in self.table['pk_columns']
-            )
-            set_columns = ','.join(
-                f'"{column}" = r."{column}"'
-                for column in self.table['all_columns']
-                if column not in self.table['pk_columns']
-            )
+        columns = ', '.join(
+            f'"{column}"'
+            for column in self.table['all_columns']
+        )
+        val_columns = ', '.join(
+            f'r."{column}"'
+            for column in self.table['all_columns']
+        )
+        where = ' and '.join(
+            f't."{column}" = r."{column}"'
+            for column in self.table['pk_columns']
+        )
+        source_where = ' and '.join(
+            f's."{column}" = r."{column}"'
+            for column in self.table['pk_columns']
+        )
+        source_columns = ', '.join(
+            f's."{column}"'
+            for column in self.table['all_columns']
+        )
+        set_columns = ','.join(
+            f'"{column}" = r."{column}"'
+            for column in self.table['all_columns']
+            if column not in self.table['pk_columns']
+        )
+        key_columns = ', '.join(
+            f'"{column}"'
+            for column in self.table['pk_columns']
+        )
+        lower_pk_values = ', '.join(
+            f'tat_lower_pk[{i}]::{pk_type}'
+            for i, pk_type in enumerate(self.table['pk_types'], 1)
+        )
+        upper_pk_values = ', '.join(
+            f'tat_upper_pk[{i}]::{pk_type}'
+            for i, pk_type in enumerate(self.table['pk_types'], 1)
+        )
+        key_range_condition = (f'(tat_lower_pk is null or ({key_columns}) > ({lower_pk_values})) and '
+                               f'(tat_upper_pk is null or ({key_columns}) <= ({upper_pk_values}))')
+        excluded_set_columns = ', '.join(
+            f'"{column}" = excluded."{column}"'
+            for column in self.table['all_columns']
+            if column not in self.table['pk_columns']
+        )
+        upsert_action = f'update set {excluded_set_columns}' if excluded_set_columns else 'nothing'
+        merge_update_action = f'update set {set_columns}' if set_columns else 'do nothing'
 
-            query = self.get_query('apply_delta.plpgsql')
-            await self.db.execute(query.format(**self.table, **locals()))
+        query = self.get_query(self.get_apply_delta_query_name())
+        for buffer in range(2 if self.args.delta_rotation else 1):
+            delta_table = self.get_delta_table(buffer)
+            apply_function = self.get_apply_function(buffer)
+            queries.append(query.format(**self.table, **locals()))
 
-            await self.cancel_autovacuum()
-            await self.db.execute(f'''
+        if self.args.delta_capture == 'statement':
+            # transition tables of a trigger are available only for its own event
+            queries.append(f'''
+                create trigger store__tat_delta
+                  after insert on {self.table_name}
+                  referencing new table as tat_new_rows
+                  for each statement execute procedure "{self.table_name}__store_delta"();
+                create trigger store__tat_delta_update
+                  after update on {self.table_name}
+                  referencing new table as tat_new_rows
+                  for each statement execute procedure "{self.table_name}__store_delta"();
+                create trigger store__tat_delta_delete
+                  after delete on {self.table_name}
+                  referencing old table as tat_old_rows
+                  for each statement execute procedure "{self.table_name}__store_delta"();
+            ''')
+        else:
+            queries.append(f'''
                 create trigger store__tat_delta
                   after insert or delete or update on {self.table_name}
                   for each row execute procedure "{self.table_name}__store_delta"();
             ''')
+        return self.get_script(queries)
 
-        for child in self.children:
-            await child.create_table_delta()
+    async def create_table_delta(self):
+        tables = [table for table in [self] + self.children if table.table_kind == TableKind.regular]
+        await self.cancel_autovacuum(tables=tables)
+        await self.run_table_scripts('create delta', [
+            (table, f'create {table.table_name}__tat_delta', table.get_create_table_delta_script())
+            for table in tables
+        ])
+
+    async def get_copiers(self, snapshot=None):
+        if snapshot:
+            parts = 1
+            if self.table['data_size'] >= self.args.copy_data_range_min_size:
+                parts = self.args.copy_data_ranges
+            copier = DataCopier(self.args, self.table, self.db, self.progress, self.throttle)
+            copiers = await copier.split_blocks(parts, snapshot)
+            if len(copiers) > 1:
+                self.log(f'copy data: split into {len(copiers)} block ranges')
+            return copiers
+        if self.args.resume:
+            copiers = await self.get_saved_copiers()
+            if copiers is not None:
+                return copiers
+        copiers = [DataCopier(self.args, self.table, self.db, self.progress, self.throttle, self.state_table_name)]
+        if self.table['data_size'] >= self.args.copy_data_range_min_size:
+            copiers = await copiers[0].split(self.args.copy_data_ranges)
+            if len(copiers) > 1:
+                self.log(f'copy data: split into {len(copiers)} ranges')
+        async with self.db.transaction() as con:  # all ranges or none, --resume must not miss a part of the table
+            for copier in copiers:
+                await copier.save_state(con)
+        return copiers
+
+    async def get_saved_copiers(self):
+        states = await self.db.fetch(f'''
+            select *
+              from {self.state_table_name}
+             where table_name = $1
+             order by part_id
+        ''', self.table_name)
+        if not states:
+            return None
+        if len(states) != states[0]['part_count']:
+            raise Exception(f'{len(states)} of {states[0]["part_count"]} ranges of {self.table_name} are saved, '
+                            f'it can not be resumed')
+        copiers = []
+        for state in states:
+            if state['done']:
+                continue
+            copier = DataCopier(self.args, self.table, self.db, self.progress, self.throttle, self.state_table_name,
+                                state['lower_pk'], state['upper_pk'], state['part_id'], state['part_count'])
+            copier.last_pk = state['last_pk'] or state['lower_pk']
+            await copier.load_pk_bounds()
+            copiers.append(copier)
+        self.log(f'copy data: resume {len(copiers)} of {len(states)} ranges')
+        return copiers
+
+    def get_descendants(self, table):
+        names = {table.table_name}
+        descendants = []
+        for child in self.children:  # children are ordered by level
+            if child.table['inherits'][0] in names:
+                names.add(child.table_name)
+                descendants.append(child)
+        return descendants
+
+    def get_analyze_query(self):
+        if self.db.server_version_num >= 180000:
+            if self.table_kind == TableKind.partitioned:
+                return f'analyze only {self.table_name}__tat_new'
+        elif self.args.analyze_jobs:
+            # analyze of partitioned table recurses into partitions, only the root is analyzed after them to collect
+            # the statistics of all partitioned tables
+            if self.table_kind == TableKind.partitioned and self.table['attach_expr']:
+                return None
+        elif self.table['attach_expr']:  # analyze of partitioned table recurses into partitions
+            return None
+        return f'analyze {self.table_name}__tat_new'
+
+    @staticmethod
+    def get_build_scheduler(args):
+        group_limits = {'copy data': args.copy_data_jobs, 'create index': args.create_index_jobs}
+        if args.analyze_jobs:
+            group_limits['analyze'] = args.analyze_jobs
+        return Scheduler(max(group_limits.values()), group_limits)
+
+    async def build_table_new(self):
+        await self.build_tables_new([self], self.log)
 
     @staticmethod
-    async def run_parallel(tasks, worker_count):
-        async def worker():
-            while tasks:
-                task = tasks.pop(0)
-                await task
-        workers = [worker() for _ in range(worker_count)]
-        await asyncio.gather(*workers)
-
-    async def copy_data(self):
+    async def build_tables_new(tats, log):
+        # tables of one run share the pool and the throttle, their builds share one scheduler, memory budget and
+        # exported snapshot
+        args, db, throttle = tats[0].args, tats[0].db, tats[0].throttle
         ts = time.time()
-        i = 0
+        scheduler = TAT.get_build_scheduler(args)
+        memory_budget = None
+        if args.maintenance_work_mem_budget:
+            memory_budget = Budget(args.maintenance_work_mem_budget)
+        snapshot = None
+        if args.batch_mode == 'ctid':
+            snapshot = ExportedSnapshot(db)
+            await snapshot.export()
+        copy_tasks = []
+        for tat in tats:
+            copy_tasks.extend(await tat.add_build_tasks(scheduler, memory_budget, snapshot))
+        if snapshot:  # the snapshot holds back vacuum, so it is released as soon as all data is copied
+            scheduler.add(snapshot.release(), 'release snapshot', 0, copy_tasks)
+        if len(tats) > 1:
+            TAT.log_border()
+            log(f'build new tables: start ({len(tats)} tables on {scheduler.worker_count} jobs)')
+        try:
+            await scheduler.run()
+        finally:
+            if snapshot:
+                await snapshot.release()
+        throttled = ''
+        if throttle.throttled_seconds:
+            throttled = f' (throttled: {datetime.timedelta(seconds=int(throttle.throttled_seconds))} of all jobs)'
+        log(f'build new tables: done in {TAT.duration(ts)}{throttled}')
+
+    async def add_build_tasks(self, scheduler, memory_budget, snapshot):
+        # adds copy, index and analyze tasks of the table and its partitions, returns the copy tasks
+        tables = [table for table in [self] + self.children if table.table_kind != TableKind.foreign]
+        copy_tasks = {}
+        index_tasks = {}
+        analyze_tasks = {}
+        key_indexes = {}
+        key_index_tasks = {}
         size = 0
-        tasks = []
-        if self.table_kind == TableKind.regular:
-            i += 1
-            size += self.table['data_size']
-            copier = DataCopier(self.args, self.table, self.db)
-            tasks.append(copier.copy_data(i))
-        for child in self.children:
-            if child.table_kind == TableKind.regular:
+        i = 0
+        for table in tables:
+            copy_tasks[table.table_name] = []
+            key_index_tasks[table.table_name] = []
+            if table.table_kind == TableKind.regular:
                 i += 1
-                size += child.table['data_size']
-                copier = DataCopier(child.args, child.table, child.db)
-                tasks.append(copier.copy_data(i))
-        pretty_size = await self.db.fetchval('select pg_size_pretty($1::bigint)', size)
-        self.log_border()
-        self.log(f'copy data: start ({len(tasks)} tables on {self.args.copy_data_jobs} jobs, size: {pretty_size})')
-        await self.run_parallel(tasks, self.args.copy_data_jobs)
-        self.log(f'copy data: done in {self.duration(ts)}')
+                size += table.table['data_size']
+                key_index = table.get_key_index()
+                if key_index:
+                    # delta of copied rows is applied by upsert, it needs the unique index of the key
+                    key_indexes[table.table_name] = key_index
+                    key_index_tasks[table.table_name].append(
+                        scheduler.add(table.create_index(key_index, 'before copy', memory_budget), 'create index',
+                                      table.get_index_cost(key_index))
+                    )
+                copiers = await table.get_copiers(snapshot)
+                for copier in copiers:
+                    if key_index:
+                        copier.apply_delta_function = f'{table.table_name}__apply_delta'
+                    copy_tasks[table.table_name].append(
+                        scheduler.add(copier.copy_data(i), 'copy data', table.table['data_size'] / len(copiers),
+                                      key_index_tasks[table.table_name])
+                    )
+        copy_count = sum(len(tasks) for tasks in copy_tasks.values())
+        self.progress.add_total('data_size', size)
 
-    async def create_indexes(self):
-        ts = time.time()
         i = 0
-        tasks = []
-        for index_def in self.table['create_indexes']:
-            i += 1
-            tasks.append(self.create_index(index_def, i))
-        for child in self.children:
-            for index_def in child.table['create_indexes']:
+        analyze_count = 0
+        for table in reversed(tables):  # partitions before their parents
+            depends_on = list(copy_tasks[table.table_name])
+            analyze_depends_on = []
+            for descendant in self.get_descendants(table):
+                if descendant.table_kind == TableKind.foreign:
+                    continue
+                # index of partitioned table is attached to already built indexes of partitions
+                depends_on.extend(copy_tasks[descendant.table_name] + index_tasks[descendant.table_name])
+                # analyze of partitioned table samples partitions, it waits for their own analyze
+                analyze_depends_on.extend(analyze_tasks[descendant.table_name])
+            index_tasks[table.table_name] = list(key_index_tasks[table.table_name])
+            for index in table.table['indexes']:
+                if index is key_indexes.get(table.table_name):
+                    continue
                 i += 1
-                tasks.append(child.create_index(index_def, i))
-        if not tasks:
-            return
+                index_tasks[table.table_name].append(
+                    scheduler.add(table.create_index(index, i, memory_budget), 'create index',
+                                  table.get_index_cost(index), depends_on)
+                )
+            analyze_tasks[table.table_name] = []
+            analyze_query = table.get_analyze_query()
+            if analyze_query:
+                analyze_count += 1
+                analyze_tasks[table.table_name].append(
+                    scheduler.add(table.analyze(analyze_query), 'analyze', table.table['data_size'],
+                                  depends_on + index_tasks[table.table_name] + analyze_depends_on)
+                )
+
+        self.progress.add_total('indexes', i + len(key_indexes))
+        pretty_size = await self.db.fetchval('select pg_size_pretty($1::bigint)', size)
+        analyze_jobs = f' on {self.args.analyze_jobs} jobs' if self.args.analyze_jobs else ''
         self.log_border()
-        self.log(f'create indexes: start ({len(tasks)} indexes on {self.args.create_index_jobs} jobs)')
-        await self.run_parallel(tasks, self.args.create_index_jobs)
-        self.log(f'create indexes: done in {self.duration(ts)}')
+        self.log(f'build new tables: start ({len(tables)} tables, size: {pretty_size}; '
+                 f'copy data: {copy_count} parts on {self.args.copy_data_jobs} jobs; '
+                 f'create indexes: {i + len(key_indexes)} indexes on {self.args.create_index_jobs} jobs; '
+                 f'analyze: {analyze_count} tables{analyze_jobs})')
+        return [task for tasks in copy_tasks.values() for task in tasks]
+
+    def get_key_index(self):
+        if (
+            not self.args.apply_delta_during_copy
+            or self.args.batch_mode == 'ctid'
+            or self.table_kind != TableKind.regular
+        ):
+            return None
+        for index in self.table['indexes']:
+            if sorted(index['unique_columns'] or []) == sorted(self.table['pk_columns']):
+                return index
+        return None
+
+    def get_index_sort_size(self, index):
+        return self.table['estimated_rows'] * ((index['key_width'] or 0) + INDEX_TUPLE_OVERHEAD)
+
+    def get_index_cost(self, index):
+        factor = INDEX_METHOD_COST_FACTORS.get(index['method'], 1)
+        return self.table['data_size'] + self.get_index_sort_size(index) * factor
+
+    def get_index_workers(self, index):
+        if self.args.index_parallel_workers is None:
+            return None
+        if (
+            self.db.server_version_num >= PARALLEL_INDEX_METHODS.get(index['method'], float('inf'))
+            and self.table['data_size'] >= PARALLEL_INDEX_MIN_SIZE
+        ):
+            return self.args.index_parallel_workers
+        return 0
 
-    async def create_index(self, index_def, i):
+    def get_index_memory(self, index):
+        memory = max(self.get_index_sort_size(index), INDEX_MIN_MEMORY)
+        # parallel build needs at least 32MB per participant
+        return max(memory, INDEX_PARTICIPANT_MIN_MEMORY * ((self.get_index_workers(index) or 0) + 1))
+
+    async def create_index(self, index, i, memory_budget=None):
+        await self.throttle.wait(self.log)  # before the memory is taken from the budget
+        if memory_budget is None:
+            await self.build_index(index, i)
+            return
+        async with memory_budget.acquire(self.get_index_memory(index)) as memory:
+            await self.build_index(index, i, memory)
+
+    async def build_index(self, index, i, memory=None):
         ts = time.time()
-        index_name = re.sub('CREATE U?N?I?Q?U?E? ?INDEX (.*) ON .*', '\\1', index_def)
-        self.log(f'create index: {index_name}: start ({i})')
-        await self.db.execute(index_def)
+        index_name = re.sub('CREATE U?N?I?Q?U?E? ?INDEX (.*) ON .*', '\\1', index['definition'])
+        definition = index['definition']
+        if self.args.resume:  # index could be built before the restart
+            definition = definition.replace(' INDEX ', ' INDEX IF NOT EXISTS ', 1)
+        settings = []
+        details = ''
+        if memory:
+            settings.append(f"set local maintenance_work_mem = '{memory // 1024}kB';")
+            details += f', maintenance_work_mem: {memory // 2 ** 20}MB'
+        workers = self.get_index_workers(index)
+        if workers is not None:
+            settings.append(f'set local max_parallel_maintenance_workers = {workers};')
+            details += f', parallel workers: {workers}'
+        self.log(f'create index: {index_name}: start ({i}{details})')
+        async with self.db.transaction() as con:
+            await con.execute('\n'.join(settings))
+            await con.execute(definition)
+        self.progress.add('indexes_done')
         self.log(f'create index: {index_name}: done ({i}) in {self.duration(ts)}')
 
-    async def apply_delta(self, con=None):
-        rows = 0
-        if self.table_kind == TableKind.regular:
-            ts = time.time()
-            self.log('apply_delta: start')
-            if con is None:
-                con = self.db
-            rows = await con.fetchval(f'select "{self.table_name}__apply_delta"();')
-            self.log(f'apply_delta: done: {rows} rows in {self.duration(ts)}')
-        for child in self.children:
-            rows += await child.apply_delta(con)
+    async def apply_table_delta(self, deadline=None):
+        ts = time.time()
+        self.log('apply_delta: start')
+        if self.args.delta_rotation:
+            rows = await self.rotate_and_apply_delta(deadline)
+        else:
+            rows, _ = await self.apply_delta_buffer(0, self.db, self.args.apply_delta_chunk_rows or None, deadline)
+        self.log(f'apply_delta: done: {rows} rows in {self.duration(ts)}')
         return rows
 
-    async def analyze(self):
+    async def apply_delta_buffer(self, buffer, con, chunk_rows=None, deadline=None):
+        # returns applied rows and whether the buffer is drained
+        rows = 0
+        while True:
+            chunk_ts = time.time()
+            chunk = await con.fetchval(f'select "{self.get_apply_function(buffer)}"($1);', chunk_rows)
+            rows += chunk
+            chunk_duration = time.time() - chunk_ts
+            self.progress.add('applied_rows', chunk)
+            self.progress.add('apply_ms', int(chunk_duration * 1000))
+            if chunk_rows is None or chunk < chunk_rows:
+                return rows, True
+            self.log(f'apply_delta: chunk: {chunk} rows in {int(chunk_duration * 1000)} ms '
+                     f'({int(chunk / max(chunk_duration, 0.001))} rows/s)')
+            if deadline is not None and time.time() >= deadline:
+                self.log('apply_delta: time budget exceeded')
+                return rows, False
+
+    async def rotate_and_apply_delta(self, deadline=None):
+        chunk_rows = self.args.apply_delta_chunk_rows or None
+        active = await self.get_active_delta_buffer()
+        # the capture can be switched only to an empty buffer, otherwise changes of a key would be out of order
+        rows, drained = await self.apply_delta_buffer(1 - active, self.db, chunk_rows, deadline)
+        if not drained:
+            return rows
+        await self.db.execute(f'truncate {self.get_delta_table(1 - active)};')
+        await self.db.execute(self.get_store_delta_query(self.get_delta_table(1 - active)))
+        async with self.db.transaction() as con:
+            # transactions which started writing to the previous buffer before the switch must be finished
+            await con.execute('set local lock_timeout = 0;')
+            await con.execute(f'lock table {self.get_delta_table(active)} in share mode;')
+        buffer_rows, drained = await self.apply_delta_buffer(active, self.db, chunk_rows, deadline)
+        if drained:
+            await self.db.execute(f'truncate {self.get_delta_table(active)};')
+        return rows + buffer_rows
+
+    def get_regular_tables(self):
+        return [table for table in [self] + self.children if table.table_kind == TableKind.regular]
+
+    def is_parallel_apply(self, locked=False):
+        # keys only delta reads rows of the original tables, under the lock only the locking connection can read them
+        if locked and self.args.delta_keys_only:
+            return False
+        return self.args.apply_delta_jobs > 1 and len(self.get_regular_tables()) > 1
+
+    async def apply_delta(self, deadline=None):
+        tables = self.get_regular_tables()
+        if not self.is_parallel_apply():
+            rows = 0
+            for table in tables:
+                if deadline is not None and time.time() >= deadline:
+                    break
+                rows += await table.apply_table_delta(deadline)
+            return rows
+
+        # Writes to the original tables are blocked by the exclusive lock, so inside the lock the
+        # delta is final and can be applied by other connections, each one commits on its own.
+        tables_rows = []
+
+        async def apply_table(table):
+            if deadline is not None and time.time() >= deadline:
+                return
+            tables_rows.append(await table.apply_table_delta(deadline))
+
+        scheduler = Scheduler(self.args.apply_delta_jobs)
+        for table in tables:
+            scheduler.add(apply_table(table), 'apply delta', table.table['data_size'])
+        await scheduler.run()
+        return sum(tables_rows)
+
+    async def analyze(self, query):
         ts = time.time()
         self.log('analyze: start')
         sys.stdout.flush()
-        await self.db.execute(f'analyze {self.table_name}__tat_new')
+        await self.db.execute(query)
         self.log(f'analyze: done in {self.duration(ts)}')
 
+    async def get_long_lock_holders(self, lock_timeout):
+        # the lock request would wait behind them until the timeout and all queries on the table would wait behind it
+        return await self.db.fetch('''
+            select a.pid,
+                   a.state,
+                   extract(epoch from now() - a.xact_start)::int as xact_seconds,
+                   left(regexp_replace(a.query, '\\s+', ' ', 'g'), 60) as query
+              from pg_stat_activity a
+             where a.pid <> pg_backend_pid() and
+                   a.backend_type <> 'autovacuum worker' and
+                   a.xact_start < now() - make_interval(secs => $2) and
+                   exists(select from pg_locks l
+                           where l.pid = a.pid and
+                                 l.locktype = 'relation' and
+                                 l.granted and
+                                 l.relation = any(select to_regclass(t) from unnest($1::text[]) t))
+             order by a.xact_start
+        ''', [table.table_name for table in [self] + self.children], lock_timeout)
+
+    async def sample_lock_queue(self, pid, queue, stop):
+        # application sessions waiting for the lock request of pid
+        while not stop.is_set():
+            pids = await self.db.fetchval('''
+                select coalesce(array_agg(pid), '{}')
+                  from pg_stat_activity
+                 where wait_event_type = 'Lock' and
+                       $1 = any(pg_blocking_pids(pid))
+            ''', pid)
+            queue['pids'].update(pids)
+            queue['max'] = max(queue['max'], len(pids))
+            queue['ms'] += len(pids) * LOCK_QUEUE_SAMPLE_INTERVAL * 1000
+            try:
+                await asyncio.wait_for(stop.wait(), LOCK_QUEUE_SAMPLE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    def pretty_lock_queue(queue):
+        if not queue['pids']:
+            return 'no sessions blocked'
+        return (f'{len(queue["pids"])} sessions blocked, up to {queue["max"]} at once, '
+                f'about {int(queue["ms"])} ms of their waiting')
+
+    def get_lock_retry_delay(self, attempt):
+        # jittered exponential backoff, the attempts do not meet the same peaks of the application load
+        delay = self.args.time_between_locks * 2 ** min(attempt - 1, LOCK_RETRY_MAX_DOUBLINGS)
+        return random.uniform(delay / 2, delay)
+
     @asynccontextmanager
     async def exclusive_lock_table(self):
-        while True:
+        # one attempt, None is yielded when the table is not locked: delta grows during the backoff,
+        # so the caller catches up with it and prepares the statements again before the next attempt
+        self.lock_attempt += 1
+        holders = await self.get_long_lock_holders(self.lock_timeout)
+        if holders:
+            self.log(f'lock table: skipped, {len(holders)} transactions longer than lock_timeout hold locks: '
+                     + ', '.join(f'pid {holder["pid"]} ({holder["state"]} '
+                                 f'{datetime.timedelta(seconds=holder["xact_seconds"])}: {holder["query"]})'
+                                 for holder in holders))
+        else:
             async with self.db.transaction() as con:
                 await self.cancel_autovacuum(con)
-                self.log('lock table: start')
+                await con.execute(f"set local lock_timeout = '{int(self.lock_timeout * 1000)}ms';")
+                self.log(f'lock table: start (lock_timeout {int(self.lock_timeout * 1000)} ms)')
+                ts = time.time()
+                queue = {'pids': set(), 'max': 0, 'ms': 0}
+                stop = asyncio.Event()
+                sampler = asyncio.create_task(self.sample_lock_queue(con.get_server_pid(), queue, stop))
                 try:
-                    await con.execute(f'lock table {self.table_name} in access exclusive mode;')
-                    self.log('lock table: done')
+                    try:
+                        await con.execute(f'lock table {self.table_name} in access exclusive mode;')
+                    finally:
+                        stop.set()
+                        await sampler
+                        self.progress.add('lock_attempts')
+                        self.progress.add('lock_blocked_ms', int(queue['ms']))
+                    self.log(f'lock table: done in {int((time.time() - ts) * 1000)} ms, '
+                             f'{self.pretty_lock_queue(queue)}')
+                    # the halved timeout is meant for the lock request only, not for the statements under the lock
+                    await con.execute(f"set local lock_timeout = '{self.args.lock_timeout}s';")
                     self.table_locked = True
+                    self.lock_time = time.time()
                     yield con
-                    break
+                    return
                 except (
                     asyncpg.exceptions.LockNotAvailableError,
                     asyncpg.exceptions.DeadlockDetectedError
@@ -312,117 +1028,239 @@ class TAT:
                     if self.table_locked:
                         await con.execute('rollback;')
                         raise e
-                    self.log(f'lock table: failed: {e}')
+                    self.log(f'lock table: failed in {int((time.time() - ts) * 1000)} ms: {e}, '
+                             f'{self.pretty_lock_queue(queue)}')
                     await con.execute('rollback;')
-            await asyncio.sleep(self.args.time_between_locks)
-
-    async def drop_depend_objects(self, con):
-        await con.execute('\n'.join(self.table['drop_views']))
-        await con.execute('\n'.join(self.table['drop_functions']))
-        if self.table['drop_constraints']:
-            await self.cancel_all_autovacuum(con)
-        await con.execute('\n'.join(self.table['drop_constraints']))
-        await con.execute('\n'.join(self.table['alter_sequences']))
-        for child in self.children:
-            await child.drop_depend_objects(con)
-
-    async def detach_foreign_tables(self, con):
-        if self.table_kind == TableKind.foreign:
-            if self.table['detach_foreign_expr']:  # declarative partitioning
-                self.log('detach foreign table')
-                await con.execute(self.table['detach_foreign_expr'])
-            else:   # old style inherits partitioning
-                self.log('no inherit foreign table')
-                await con.execute(
-                    f'alter table {self.table_name} no inherit {self.table["inherits"][0]}'
-                )
-        for child in self.children:
-            await child.detach_foreign_tables(con)
-
-    async def attach_foreign_tables(self, con):
-        if self.table_kind == TableKind.foreign:
-            if self.columns:
-                await con.execute(
-                    ''.join(
-                        '''
-                        alter table {name}
-                          alter column {column}
-                            type {type};
-                        '''.format(**self.table, **column)
-                        for column in self.columns
-                    )
-                )
-            if self.table['attach_foreign_expr']:  # declarative partitioning
-                self.log('attach foreign table')
-                await con.execute(self.table['attach_foreign_expr'])
-            else:  # old style inherits partitioning
-                self.log('inherit foreign table')
-                await con.execute(
-                    f'alter table {self.table_name} inherit {self.table["inherits"][0]}'
-                )
-        for child in self.children:
-            await child.attach_foreign_tables(con)
+                    if queue['pids']:  # queries waited behind the lock request, the next one waits less
+                        self.lock_timeout = max(self.lock_timeout / 2, LOCK_TIMEOUT_MIN)
+        delay = self.get_lock_retry_delay(self.lock_attempt)
+        self.log(f'lock table: next attempt in {delay:.1f} s')
+        await asyncio.sleep(delay)
+        yield None
+
+    def get_drop_depend_objects_script(self):
+        tables = [self] + self.children
+        cancel_autovacuum = ''
+        if any(table.table['drop_constraints'] for table in tables):
+            cancel_autovacuum = self.get_cancel_all_autovacuum_query()
+        return self.get_script(cancel_autovacuum, *(
+            query
+            for table in tables
+            for query in [table.table['drop_views'], table.table['drop_functions'], table.table['drop_constraints'],
+                          table.table['alter_sequences']]
+        ))
 
-    async def drop_original_table(self, con):
-        self.log('drop original table')
+    def get_detach_foreign_table_script(self):
+        if self.table['detach_foreign_expr']:  # declarative partitioning
+            return self.table['detach_foreign_expr']
+        else:   # old style inherits partitioning
+            return f'alter table {self.table_name} no inherit {self.table["inherits"][0]};'
+
+    def get_attach_foreign_table_script(self):
+        alter_columns = [
+            '''
+            alter table {name}
+              alter column {column}
+                type {type};
+            '''.format(**self.table, **column)
+            for column in self.columns
+        ]
+        if self.table['attach_foreign_expr']:  # declarative partitioning
+            return self.get_script(alter_columns, self.table['attach_foreign_expr'])
+        else:  # old style inherits partitioning
+            return self.get_script(alter_columns, f'alter table {self.table_name} inherit {self.table["inherits"][0]};')
+
+    def get_drop_original_table_script(self):
+        drop_tables = []
         if self.table_kind == TableKind.regular and self.children:  # old style inherits partitioning
-            for child in reversed(self.children):
-                if child.table_kind == TableKind.regular:
-                    await con.execute(f'drop table {child.table_name};')
-        await con.execute(f'drop table {self.table_name};')
+            drop_tables = [
+                f'drop table {child.table_name};'
+                for child in reversed(self.children)
+                if child.table_kind == TableKind.regular
+            ]
+        return self.get_script(drop_tables, f'drop table {self.table_name};')
 
-    async def rename_table(self, con):
-        if self.table_kind == TableKind.foreign:
-            return
-        self.log(f'rename table {self.table_name}__tat_new -> {self.table_name}')
-        await con.execute(f'alter table {self.table_name}__tat_new rename to {self.table["name_without_schema"]};')
-        await con.execute('\n'.join(self.table['rename_indexes']))
-        await con.execute('\n'.join(self.table['create_constraints']))
-        await con.execute('\n'.join(self.table['create_triggers']))
-        await con.execute(self.table['replica_identity'])
-        await con.execute('\n'.join(self.table['publications']))
-        await con.execute(f'alter table {self.table_name} reset (autovacuum_enabled);')
-        await con.execute('\n'.join(self.table['storage_parameters']))
-        for child in self.children:
-            await child.rename_table(con)
+    def get_rename_table_script(self):
+        return self.get_script(
+            f'alter table {self.table_name}__tat_new rename to {self.table["name_without_schema"]};',
+            self.table['rename_indexes'],
+            self.table['create_constraints'],
+            self.table['create_triggers'],
+            self.table['replica_identity'],
+            self.table['publications'],
+            f'alter table {self.table_name} reset (autovacuum_enabled);',
+            [
+                parameter
+                for parameter in self.table['storage_parameters']
+                # autovacuum of the table was disabled by the interrupted run, it is not a parameter of the table
+                if not (self.args.resume and parameter.endswith('(autovacuum_enabled=false);'))
+            ],
+        )
+
+    def get_recreate_depend_objects_script(self):
+        return self.get_script(
+            self.table['create_functions'],
+            [
+                acl_to_grants(params['acl'],
+                              params['obj_type'],
+                              params['obj_name'])
+                for params in self.table['function_acl_to_grants_params']
+            ],
+            self.table['create_views'],
+            [
+                acl_to_grants(params['acl'],
+                              params['obj_type'],
+                              params['obj_name'])
+                for params in self.table['view_acl_to_grants_params']
+            ],
+            self.table['comment_views'],
+        )
 
     async def recreate_depend_objects(self, con):
-        await con.execute('\n'.join(self.table['create_functions']))
-        await con.execute('\n'.join(
-            acl_to_grants(params['acl'],
-                          params['obj_type'],
-                          params['obj_name'])
-            for params in self.table['function_acl_to_grants_params']
+        await con.execute(self.get_script(
+            table.get_recreate_depend_objects_script()
+            for table in [self] + self.children
         ))
-        await con.execute('\n'.join(self.table['create_views']))
-        await con.execute('\n'.join(
-            acl_to_grants(params['acl'],
-                          params['obj_type'],
-                          params['obj_name'])
-            for params in self.table['view_acl_to_grants_params']
-        ))
-        await con.execute('\n'.join(self.table['comment_views']))
-        for child in self.children:
-            await child.recreate_depend_objects(con)
+
+    async def get_delta_state(self):
+        # ids of the delta are serial, so a backlog and an ingest rate are got by the primary key index only
+        delta_queries = []
+        for table in [self] + self.children:
+            if table.table_kind != TableKind.regular:
+                continue
+            delta_queries.append(f"""
+                select max(tat_delta_id) - min(tat_delta_id) + 1 as backlog,
+                       pg_sequence_last_value(pg_get_serial_sequence('{table.table_name}__tat_delta',
+                                                                     'tat_delta_id')::regclass) as last_id
+                  from {table.table_name}__tat_delta""")
+            if self.args.delta_rotation:  # both buffers use the sequence of the first one
+                delta_queries.append(f"""
+                    select max(tat_delta_id) - min(tat_delta_id) + 1 as backlog,
+                           null as last_id
+                      from {table.get_delta_table(1)}""")
+        delta_queries = ' union all '.join(delta_queries)
+        state = await self.db.fetchrow(f'''
+            select coalesce(sum(backlog), 0)::bigint as backlog,
+                   coalesce(sum(last_id), 0)::bigint as last_id
+              from ({delta_queries}) s
+        ''')
+        return dict(state, time=time.time())
+
+    async def catch_up(self):
+        last_delta_state = await self.get_delta_state()
+        non_converging_passes = 0
+        best_lock_ms = None
+        min_pass_ms = None
+        while True:
+            deadline = None
+            if self.args.apply_delta_time_budget:
+                deadline = time.time() + self.args.apply_delta_time_budget
+            pass_ts = time.time()
+            rows = await self.apply_delta(deadline=deadline)
+            deadline_exceeded = deadline is not None and time.time() >= deadline
+            if not self.args.max_lock_ms:
+                if rows <= self.args.min_delta_rows and not deadline_exceeded:
+                    break
+                continue
+
+            # the locked apply is estimated by the speed of the last pass, it includes per table overhead
+            pass_duration = time.time() - pass_ts
+            delta_state = await self.get_delta_state()
+            backlog = delta_state['backlog']
+            ingest_rate = ((delta_state['last_id'] - last_delta_state['last_id'])
+                           / max(delta_state['time'] - last_delta_state['time'], 0.001))
+            apply_rate = rows / max(pass_duration, 0.001)
+            lock_ms = int(pass_duration * 1000 * max(backlog, 1) / max(rows, 1))
+            min_pass_ms = min(int(pass_duration * 1000), min_pass_ms or float('inf'))
+            self.log(f'catch up: {rows} rows applied in {int(pass_duration * 1000)} ms, backlog: {backlog} rows, '
+                     f'ingest: {int(ingest_rate)} rows/s, apply: {int(apply_rate)} rows/s, '
+                     f'estimated lock: {lock_ms} ms')
+            if lock_ms <= self.args.max_lock_ms and not deadline_exceeded:
+                break
+            # an empty backlog is not progress either, the fixed cost of a pass over all tables can exceed the limit
+            if best_lock_ms is not None and lock_ms >= best_lock_ms:
+                non_converging_passes += 1
+                self.log(f'catch up: delta is not converging ({non_converging_passes}/{NON_CONVERGING_PASSES})')
+                if non_converging_passes >= NON_CONVERGING_PASSES:
+                    raise Exception(f'delta is not converging: ingest {int(ingest_rate)} rows/s, '
+                                    f'apply {int(apply_rate)} rows/s, backlog {backlog} rows, '
+                                    f'estimated lock {lock_ms} ms > --max-lock-ms {self.args.max_lock_ms}, '
+                                    f'fixed cost of a pass over {len(self.get_regular_tables())} tables '
+                                    f'{min_pass_ms} ms')
+            else:
+                best_lock_ms = lock_ms
+                non_converging_passes = 0
+            last_delta_state = delta_state
+
+    async def get_apply_delta_script(self):
+        # writes are blocked by the lock, so the rest of delta is final and applied by the switch script
+        if self.is_parallel_apply(locked=True):
+            return ''
+        queries = []
+        for table in self.get_regular_tables():
+            buffers = [0]
+            if self.args.delta_rotation:  # the older buffer first, only this process switches the capture
+                active = await table.get_active_delta_buffer()
+                buffers = [1 - active, active]
+            queries.extend(f'select "{table.get_apply_function(buffer)}"();' for buffer in buffers)
+        return self.get_script(queries)
+
+    async def get_switch_script(self):
+        tables = [self] + self.children
+        foreign_tables = [table for table in tables if table.table_kind == TableKind.foreign]
+        return self.get_script(
+            await self.get_apply_delta_script(),
+            self.get_drop_depend_objects_script(),
+            [table.get_cleanup_script(with_tat_new=False) for table in reversed(tables)],
+            [table.get_detach_foreign_table_script() for table in foreign_tables],
+            self.get_drop_original_table_script(),
+            [table.get_rename_table_script() for table in tables if table.table_kind != TableKind.foreign],
+            [table.get_attach_foreign_table_script() for table in foreign_tables],
+            [table.get_recreate_depend_objects_script() for table in tables],
+        )
+
+    async def run_switch_script(self, con, switch_script):
+        if self.is_parallel_apply(locked=True):
+            await self.apply_delta()
+        ts = time.time()
+        await con.execute(switch_script)
+        self.log(f'switch script: {len(self.children) + 1} tables in {int((time.time() - ts) * 1000)} ms')
+
+    def get_lock_hold_budget(self):
+        # the commit is not covered, it can not be rolled back any more
+        if not self.args.max_lock_hold:
+            return None
+        return self.args.max_lock_hold / 1000 - (time.time() - self.lock_time)
 
     async def switch_table(self):
         self.log_border()
         self.log('switch table: start')
+        await self.log_delta_capture_stats()
 
+        lock_hold_attempts = 0
         while True:
-            rows = await self.apply_delta()
-            if rows <= self.args.min_delta_rows:
-                break
-
-        async with self.exclusive_lock_table() as con:
-            await self.apply_delta(con)
-            await self.drop_depend_objects(con)
-            await self.cleanup(con, with_tat_new=False)
-            await self.detach_foreign_tables(con)
-            await self.drop_original_table(con)
-            await self.rename_table(con)
-            await self.attach_foreign_tables(con)
-            await self.recreate_depend_objects(con)
+            await self.catch_up()
+            # everything under the lock is prepared before it and sent in one round trip
+            switch_script = await self.get_switch_script()
+            try:
+                async with self.exclusive_lock_table() as con:
+                    if con is None:  # not locked, delta of the backoff is caught up before the next attempt
+                        continue
+                    await asyncio.wait_for(self.run_switch_script(con, switch_script), self.get_lock_hold_budget())
+            except asyncio.TimeoutError:
+                self.table_locked = False
+                lock_hold_attempts += 1
+                self.log(f'switch table: lock held {int((time.time() - self.lock_time) * 1000)} ms, '
+                         f'over --max-lock-hold {self.args.max_lock_hold} ms, rolled back '
+                         f'({lock_hold_attempts}/{MAX_LOCK_HOLD_ATTEMPTS})')
+                if lock_hold_attempts >= MAX_LOCK_HOLD_ATTEMPTS:
+                    raise Exception(f'switch does not fit into --max-lock-hold {self.args.max_lock_hold} ms')
+                await asyncio.sleep(self.args.time_between_locks)
+                continue
+            lock_held_ms = int((time.time() - self.lock_time) * 1000)
+            self.progress.add('lock_held_ms', lock_held_ms)
+            self.log(f'switch table: lock held {lock_held_ms} ms')
+            break
         self.log('switch table: done')
 
     async def validate_constraints(self):
@@ -437,26 +1275,88 @@ class TAT:
             return
         ts = time.time()
         constraints_count = len(self.table["validate_constraints"])
-        self.log(f'validate constraints: start ({constraints_count})')
+        # validations of one table conflict on its lock, so constraints are validated in parallel by tables
+        tables_constraints = {}
         for constraint in self.table['validate_constraints']:
-            loop_ts = time.time()
+            table_name = re.sub('alter table (.*) validate constraint (.*);', '\\1', constraint)
+            tables_constraints.setdefault(table_name, []).append(constraint)
+        self.log(f'validate constraints: start ({constraints_count} constraints of {len(tables_constraints)} tables '
+                 f'on {self.args.validate_constraints_jobs} jobs)')
+        scheduler = Scheduler(self.args.validate_constraints_jobs)
+        for constraints in tables_constraints.values():
+            scheduler.add(self.validate_table_constraints(constraints), 'validate constraints', len(constraints))
+        await scheduler.run()
+        self.log(f'validate constraints: done in {self.duration(ts)}')
+
+    async def validate_table_constraints(self, constraints):
+        for constraint in constraints:
+            ts = time.time()
             constraint_name = re.sub('alter table (.*) validate constraint (.*);', '\\1: \\2', constraint)
             self.log(f'validate constraint: {constraint_name}: start')
             await self.db.execute(constraint)
-            self.log(f'validate constraint: {constraint_name}: done in {self.duration(loop_ts)}')
-        self.log(f'validate constraints: done in {self.duration(ts)}')
+            self.log(f'validate constraint: {constraint_name}: done in {self.duration(ts)}')
+
+    def get_cleanup_script(self, with_tat_new=True):
+        return self.get_script(
+            f'''
+            drop trigger if exists store__tat_delta on {self.table_name};
+            drop trigger if exists store__tat_delta_update on {self.table_name};
+            drop trigger if exists store__tat_delta_delete on {self.table_name};
+            ''',
+            f'drop function if exists "{self.table_name}__store_delta"();',
+            f'drop function if exists "{self.table_name}__apply_delta";',
+            f'drop function if exists "{self.table_name}__apply_delta_2";',
+            f'drop table if exists {self.table_name}__tat_delta_2;',  # uses the sequence of __tat_delta
+            f'drop table if exists {self.table_name}__tat_delta;',
+            self.state_table_name and not self.is_sub_table and f'drop table if exists {self.state_table_name};',
+            with_tat_new and f'drop table if exists {self.table_name}__tat_new;',
+        )
+
+    async def cleanup(self):
+        await self.run_table_scripts('cleanup', [
+            (table, 'cleanup', table.get_cleanup_script())
+            for table in [self] + self.children
+        ], reverse=True)
+
+    def check_delta_capture(self):
+        if self.args.delta_keys_only and self.args.apply_delta_mode == 'row':
+            raise Exception('--delta-keys-only is applied by set only, it can not be used with --apply-delta-mode row')
+        # statements on a partitioned table fire statement triggers of the partitioned table only
+        if self.args.delta_capture == 'statement' and (self.children or self.table['inherits']):
+            raise Exception(f'--delta-capture statement is not supported for table {self.table_name} '
+                            f'with partitions or inheritance')
+
+    async def get_delta_capture_stats(self):
+        return await self.db.fetchrow('''
+            select count(f.funcid) as functions,
+                   coalesce(sum(f.calls), 0)::bigint as calls,
+                   coalesce(sum(f.self_time), 0)::float as self_time
+              from unnest($1::text[]) t(name)
+              left join pg_stat_user_functions f
+                     on f.funcid = to_regproc(quote_ident(t.name))
+        ''', [
+            f'{table.table_name}__store_delta'
+            for table in [self] + self.children
+            if table.table_kind == TableKind.regular
+        ])
 
-    async def cleanup(self, db=None, with_tat_new=True):
-        if not db:
-            db = self.db
-        for child in reversed(self.children):
-            await child.cleanup(db, with_tat_new)
-        await db.execute(f'drop trigger if exists store__tat_delta on {self.table_name};')
-        await db.execute(f'drop function if exists "{self.table_name}__store_delta"();')
-        await db.execute(f'drop function if exists "{self.table_name}__apply_delta"();')
-        await db.execute(f'drop table if exists {self.table_name}__tat_delta;')
-        if with_tat_new:
-            await db.execute(f'drop table if exists {self.table_name}__tat_new;')
+    async def log_delta_capture_stats(self):
+        stats = await self.get_delta_capture_stats()
+        if not stats['functions']:
+            self.log("delta capture: no statistics, set track_functions = 'pl' to measure the trigger overhead")
+            return
+        rows = (await self.get_delta_state())['last_id']
+        self.log(f'delta capture ({self.args.delta_capture}): {stats["calls"]} trigger calls, {rows} rows, '
+                 f'{int(stats["self_time"])} ms total, '
+                 f'{stats["self_time"] * 1000 / max(rows, 1):.1f} us per row')
+
+    def check_batch_mode(self):
+        if self.args.batch_mode != 'ctid':
+            return
+        if self.db.server_version_num < 140000:
+            raise Exception('--batch-mode ctid needs tid range scan of postgres 14+')
+        if self.args.resume:
+            raise Exception('--batch-mode ctid can not be resumed, the exported snapshot is lost, use --cleanup')
 
     def check_sub_table(self):
         if self.table['inherits'] and not self.is_sub_table:
@@ -466,28 +1366,77 @@ class TAT:
         if self.table['inherits'] and len(self.table['inherits']) > 1:
             raise Exception('Multi inherits not supported')
 
+    def log_startup(self, ts):
+        self.log(f'startup: {int((time.time() - ts) * 1000)} ms, catalog of {len(self.children) + 1} tables '
+                 f'read in {self.catalog_ms} ms')
+
+    def start(self):
+        self.log(f'start ({self.table["pretty_size"]})')
+        if self.own_progress:
+            self.progress.set_tables(self.table_name, self.get_progress_tables())
+            self.progress.start_reporter()
+
+    def get_progress_tables(self):
+        return [table.table_name for table in self.get_regular_tables()]
+
+    async def prepare(self):
+        self.check_sub_table()
+        self.check_delta_capture()
+        self.check_batch_mode()
+        if self.is_catalog_only():
+            return
+        self.progress.set_phase('prepare')
+        if self.args.resume:
+            await self.check_resume()
+        else:
+            await self.create_table_state()
+            await self.create_table_new()
+            await self.create_table_delta()
+
+    async def switch(self):
+        self.progress.set_phase('switch')
+        if self.is_catalog_only():
+            await self.alter_table_in_place()
+        else:
+            await self.switch_table()
+
+    async def abort(self):
+        if self.own_progress:
+            await self.progress.stop_reporter()
+        await self.cancel_autovacuum()
+        await self.db.execute(f'alter table {self.table_name} reset (autovacuum_enabled);')
+
+    async def finish(self, ts):
+        if not self.is_catalog_only():  # existing constraints are kept by the in place alter
+            self.progress.set_phase('validate')
+            await self.validate_constraints()
+        if self.own_progress:
+            await self.progress.stop_reporter()
+            self.log(f'phases: {self.progress.pretty_phase_durations()}')
+        self.log(f'done in {self.duration(ts)}\n')
+
     async def run(self):
         ts = time.time()
         await self.db.init_pool()
         await self.get_table_info()
+        self.log_startup(ts)
+        if not self.columns:
+            print('no column to alter, use --force to alter anyway')
+            sys.exit(0)
 
         if self.args.cleanup:
             await self.cancel_autovacuum()
             await self.cleanup()
             return
 
-        self.log(f'start ({self.table["pretty_size"]})')
+        self.start()
         try:
-            self.check_sub_table()
-            await self.create_table_new()
-            await self.create_table_delta()
-            await self.copy_data()
-            await self.create_indexes()
-            await self.analyze()
-            await self.switch_table()
+            await self.prepare()
+            if not self.is_catalog_only():
+                self.progress.set_phase('build')
+                await self.build_table_new()
+            await self.switch()
         except Exception as e:
-            await self.cancel_autovacuum()
-            await self.db.execute(f'alter table {self.table_name} reset (autovacuum_enabled);')
+            await self.abort()
             raise e
-        await self.validate_constraints()
-        self.log(f'done in {self.duration(ts)}\n')
+        await self.finish(ts)
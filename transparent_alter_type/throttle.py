@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+THROTTLE_SLEEP = 1
+WAL_RATE_MIN_INTERVAL = 1
+
+
+class Throttle:
+    # pauses copy batches and index builds while replicas lag behind or wal is written too fast
+    def __init__(self, args, db):
+        self.args = args
+        self.db = db
+        self.lock = None  # created in the running loop, before python 3.10 a lock is bound to the loop of __init__
+        self.last_lsn = None
+        self.last_lsn_time = None
+        self.wal_rate = 0
+        self.throttled_seconds = 0
+
+    @property
+    def enabled(self):
+        return bool(self.args.max_replication_lag or self.args.max_wal_rate)
+
+    async def sample(self):
+        state = await self.db.fetchrow('''
+            select pg_current_wal_lsn() as lsn,
+                   (select max(pg_wal_lsn_diff(pg_current_wal_lsn(), coalesce(replay_lsn, flush_lsn)))
+                      from pg_stat_replication)::bigint as replication_lag
+        ''')
+        now = time.time()
+        if self.last_lsn is None:
+            self.last_lsn, self.last_lsn_time = state['lsn'], now
+        elif now - self.last_lsn_time >= WAL_RATE_MIN_INTERVAL:
+            wal_bytes = await self.db.fetchval('select pg_wal_lsn_diff($1, $2)::bigint', state['lsn'], self.last_lsn)
+            self.wal_rate = wal_bytes / (now - self.last_lsn_time)
+            self.last_lsn, self.last_lsn_time = state['lsn'], now
+        return state['replication_lag'] or 0
+
+    async def get_reason(self):
+        replication_lag = await self.sample()
+        if self.args.max_replication_lag and replication_lag > self.args.max_replication_lag:
+            return f'replication lag {replication_lag // 2 ** 20}MB'
+        if self.args.max_wal_rate and self.wal_rate > self.args.max_wal_rate:
+            return f'wal rate {int(self.wal_rate) // 2 ** 20}MB/s'
+        return None
+
+    async def wait(self, log):
+        if not self.enabled:
+            return 0
+        ts = time.time()
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:  # concurrent workers share one sampling loop
+            reason = await self.get_reason()
+            if not reason:
+                return 0
+            log(f'throttle: {reason}, pause')
+            while reason:
+                await asyncio.sleep(THROTTLE_SLEEP)
+                reason = await self.get_reason()
+        throttled_seconds = time.time() - ts
+        self.throttled_seconds += throttled_seconds
+        return throttled_seconds